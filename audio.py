@@ -1,10 +1,16 @@
 import os
 import subprocess
-import wave
+import struct
+import sqlite3
+import multiprocessing.pool
+import itertools
+import collections
 import json
+import math
+import functools
 import torch
+import torch.nn.functional as F
 import numpy as np
-import librosa
 import soundfile
 import scipy.io.wavfile
 
@@ -29,105 +35,339 @@ def read_audio(
 		raw_num_channels=None,
 ):
 	assert dtype in [None, 'int16', 'float32']
-	assert backend in [None, 'scipy', 'soundfile', 'ffmpeg', 'sox']
+	assert backend in [None, 'scipy', 'soundfile', 'ffmpeg', 'sox', 'mmap', 'pyav']
+
+	if backend == 'mmap' and audio_path is not None and audio_path.endswith('.wav') and read_wav_header(audio_path)[2] is None:
+		# formats that cannot be memory-mapped as is (e.g. 24-bit PCM) are decoded by soundfile
+		backend = 'soundfile'
 
 	try:
 		if audio_path is None or audio_path.endswith('.raw'):
+			sample_rate_ = raw_sample_rate
+			begin, end, begin_, end_ = resample_frame_range(offset, duration, sample_rate_, sample_rate)
+			frame_size = np.dtype(raw_dtype).itemsize * raw_num_channels
 			if audio_path is not None:
+				num_frames = os.path.getsize(audio_path) // frame_size
 				with open(audio_path, 'rb') as f:
-					raw_bytes = f.read()
-			sample_rate_, signal = raw_sample_rate, np.frombuffer(raw_bytes, dtype = raw_dtype).reshape(-1, raw_num_channels)
+					f.seek(begin_ * frame_size)
+					raw_bytes = f.read(max(0, end_ - begin_) * frame_size if end_ is not None else -1)
+			else:
+				num_frames = len(raw_bytes) // frame_size
+				raw_bytes = raw_bytes[begin_ * frame_size : end_ * frame_size if end_ is not None else None]
+			signal = np.frombuffer(raw_bytes, dtype = raw_dtype, count = len(raw_bytes) // frame_size * raw_num_channels).reshape(-1, raw_num_channels)
+
+		elif backend == 'mmap' and audio_path.endswith('.wav'):
+			# zero-copy: signal is a strided view over the page cache, only the used window is converted below
+			sample_rate_, num_channels, raw_dtype_, data_offset, num_frames = read_wav_header(audio_path)
+			begin, end, begin_, end_ = resample_frame_range(offset, duration, sample_rate_, sample_rate)
+			signal = np.memmap(audio_path, dtype = raw_dtype_, mode = 'r', offset = data_offset, shape = (num_frames, num_channels))[begin_:end_] if num_frames > 0 else np.empty(shape = (0, num_channels), dtype = raw_dtype_)
 
 		elif backend in ['scipy', None] and audio_path.endswith('.wav'):
-			sample_rate_, signal = scipy.io.wavfile.read(audio_path)
+			# mmap makes slicing read only the requested frames from disk
+			sample_rate_, signal = scipy.io.wavfile.read(audio_path, mmap = True)
 			signal = signal[:, None] if len(signal.shape) == 1 else signal
+			begin, end, begin_, end_ = resample_frame_range(offset, duration, sample_rate_, sample_rate)
+			num_frames, signal = len(signal), np.array(signal[begin_:end_])
 
 		elif backend == 'soundfile':
-			signal, sample_rate_ = soundfile.read(audio_path, dtype = raw_dtype)
-			signal = signal[:, None] if len(signal.shape) == 1 else signal
-
-		elif backend == 'sox':
-			num_channels = int(subprocess.check_output(['soxi', '-V0', '-c', audio_path])) if not mono else 1
-			params_fmt = ['-b', '16', '-e', 'signed'] if raw_dtype == 'int16' else ['-b', '32', '-e', 'float']
-			params = [
-				'sox',
-				'-V0',
-				audio_path
-				] + params_fmt +[
-				'--endian',
-				byte_order,
-				'-r',
-				str(sample_rate),
-				'-c',
-				str(num_channels),
-				'-t',
-				'raw',
-				'-'
-			]
-			sample_rate_, signal = sample_rate, np.frombuffer(subprocess.check_output(params), dtype = raw_dtype).reshape(-1, num_channels)
-		elif backend in ['ffmpeg', None]:
-			num_channels = int(
-				subprocess.check_output([
-					'ffprobe',
-					'-i',
-					audio_path,
-					'-show_entries',
-					'stream=channels',
-					'-select_streams',
-					'a:0',
-					'-of',
-					'compact=p=0:nk=1',
-					'-v',
-					'0'
-				])
-			) if not mono else 1
-			params_fmt = ['-f', 's16le'] if raw_dtype == 'int16' else ['-f', 'f32le']
-			params = [
-				'ffmpeg',
-				'-i',
-				audio_path,
-				'-nostdin',
-				'-hide_banner',
-				'-nostats',
-				'-loglevel',
-				'quiet'] + params_fmt + [
-				'-ar',
-				str(sample_rate),
-				'-ac',
-				str(num_channels),
-				'-'
-			]
+			with soundfile.SoundFile(audio_path) as f:
+				sample_rate_, num_frames = f.samplerate, f.frames
+				begin, end, begin_, end_ = resample_frame_range(offset, duration, sample_rate_, sample_rate)
+				f.seek(min(begin_, f.frames))
+				signal = f.read(frames = max(0, end_ - begin_) if end_ is not None else -1, dtype = raw_dtype, always_2d = True)
+
+		elif backend == 'pyav':
+			# in-process libav decoding, avoids ffprobe + ffmpeg fork/exec per file
+			import av
+			begin, end = frame_range(offset, duration, sample_rate)
+			with av.open(audio_path) as container:
+				stream = container.streams.audio[0]
+				num_channels = stream.channels if not mono else 1
+				resampler = av.AudioResampler(format = 's16' if raw_dtype == 'int16' else 'flt', layout = 'mono' if mono else stream.layout.name, rate = sample_rate)
+				frames, num_frames = container.decode(stream), 0
+				if begin and stream.codec_context.name.startswith('pcm_') and stream.rate == sample_rate:
+					# pcm frame timestamps are sample-exact, other codecs are decoded from the beginning counting resampled frames,
+					# because keyframe seeking is not; stream timestamps do not necessarily start at zero
+					start_time = stream.start_time or 0
+					container.seek(start_time + int(begin / (stream.time_base * sample_rate)), stream = stream)
+					frame = next(frames, None)
+					if frame is not None and frame.pts is not None:
+						num_frames = round((frame.pts - start_time) * stream.time_base * sample_rate)
+						assert num_frames <= begin, f'Seek past requested offset [{audio_path}]'
+						frames = itertools.chain([frame], frames)
+					else:
+						# without timestamps the position after seeking is unknown, so frames are counted from the beginning
+						container.seek(start_time, stream = stream)
+						frames = container.decode(stream)
+				chunks = []
+				for frame in itertools.chain(frames, [None]):
+					for resampled in resampler.resample(frame):
+						chunk = resampled.to_ndarray().reshape(-1, num_channels)
+						chunks.append(chunk[max(0, begin - num_frames) : max(0, end - num_frames) if end is not None else None])
+						num_frames += len(chunk)
+					if end is not None and num_frames >= end:
+						break
+			sample_rate_, signal = sample_rate, np.concatenate(chunks) if chunks else np.empty(shape = (0, num_channels), dtype = raw_dtype)
+
+		elif backend in ['ffmpeg', 'sox', None]:
+			num_channels = probe_num_channels(audio_path, backend) if not mono else 1
+			begin, end = frame_range(offset, duration, sample_rate)
+			params = decoder_cmd(audio_path, backend, sample_rate, num_channels, raw_dtype = raw_dtype, byte_order = byte_order, begin = begin, end = end)
 			sample_rate_, signal = sample_rate, np.frombuffer(subprocess.check_output(params), dtype = raw_dtype).reshape(-1, num_channels)
+			signal = signal[:max(0, end - begin)] if end is not None else signal
 
-	except:
+	except Exception:
 		print(f'Error when reading [{audio_path}]')
 		sample_rate_, signal = sample_rate, np.empty(shape = (0, 1), dtype = dtype)
 
-	if offset or duration is not None:
-		signal = signal[
-						slice(
-							int(offset * sample_rate_) if offset else None,
-							int((offset + duration) * sample_rate_) if duration is not None else None
-						)]
-	
+	# decoders resample themselves, other backends read the window with resampling filter context around it
+	if sample_rate_ == sample_rate:
+		return convert_signal(signal, sample_rate_, sample_rate, mono = mono, dtype = dtype)
+	return convert_signal(signal, sample_rate_, sample_rate, mono = mono, dtype = dtype, begin = begin, end = end, signal_begin = begin_, num_frames = num_frames)
+
+
+def read_audio_chunks(
+		audio_path,
+		sample_rate,
+		chunk_seconds,
+		overlap_seconds = 0.0,
+		mono = True,
+		raw_dtype = 'int16',
+		dtype = 'float32',
+		byte_order = 'little',
+		backend = None
+):
+	'''
+	Yields (offset, signal) pairs, signal is shaped CT and lasts chunk_seconds (the last chunk may be shorter),
+	consecutive chunks overlap by overlap_seconds. Memory is bounded by a single chunk regardless of audio duration.
+	'''
+	assert 0 <= overlap_seconds < chunk_seconds
+	chunk_len, overlap_len = int(chunk_seconds * sample_rate), int(overlap_seconds * sample_rate)
+	step = chunk_len - overlap_len
+
+	if backend == 'pyav' or (backend in ['ffmpeg', 'sox', None] and not audio_path.endswith('.wav') and not audio_path.endswith('.raw')):
+		# a single decoder streams frames resampled as a whole, chunks are cut as they arrive
+		frames = decode_frames(audio_path, backend, sample_rate, mono = mono, raw_dtype = raw_dtype, byte_order = byte_order, block_size = chunk_len)
+		try:
+			offset, tail = 0, None
+			for block in frames:
+				tail = np.concatenate([tail, block]) if tail is not None else block
+				while len(tail) >= chunk_len:
+					yield offset / sample_rate, convert_signal(tail[:chunk_len], sample_rate, sample_rate, mono = mono, dtype = dtype)[0]
+					offset, tail = offset + step, tail[step:]
+			# the last chunk is yielded unless all of its frames were already yielded within the previous chunk
+			if tail is not None and len(tail) > (overlap_len if offset > 0 else 0):
+				yield offset / sample_rate, convert_signal(tail, sample_rate, sample_rate, mono = mono, dtype = dtype)[0]
+		finally:
+			frames.close()
+	else:
+		# seekable backends read each window separately, frame_range is in units of sample_rate for all backends, so windows are
+		# exact slices of the full read (half a frame is added to survive float rounding) and are resampled with filter context
+		for offset in itertools.count(0, step):
+			signal, _ = read_audio(audio_path, sample_rate, offset = (offset + 0.5) / sample_rate, duration = chunk_len / sample_rate, mono = mono, raw_dtype = raw_dtype, dtype = dtype, byte_order = byte_order, backend = backend)
+			signal = signal[..., :chunk_len]
+			if signal.shape[-1] <= (overlap_len if offset > 0 else 0):
+				break
+			yield offset / sample_rate, signal
+			if signal.shape[-1] < chunk_len:
+				break
+
+
+def decode_frames(audio_path, backend, sample_rate, mono = True, raw_dtype = 'int16', byte_order = 'little', block_size = 2 ** 16):
+	# yields blocks of frames shaped TC of the whole stream decoded and resampled to sample_rate by pyav or a decoder process
+	if backend == 'pyav':
+		import av
+		with av.open(audio_path) as container:
+			stream = container.streams.audio[0]
+			num_channels = stream.channels if not mono else 1
+			resampler = av.AudioResampler(format = 's16' if raw_dtype == 'int16' else 'flt', layout = 'mono' if mono else stream.layout.name, rate = sample_rate)
+			for frame in itertools.chain(container.decode(stream), [None]):
+				for resampled in resampler.resample(frame):
+					yield resampled.to_ndarray().reshape(-1, num_channels)
+		return
+
+	num_channels = probe_num_channels(audio_path, backend) if not mono else 1
+	frame_size = np.dtype(raw_dtype).itemsize * num_channels
+	proc = subprocess.Popen(decoder_cmd(audio_path, backend, sample_rate, num_channels, raw_dtype = raw_dtype, byte_order = byte_order), stdout = subprocess.PIPE, stderr = subprocess.DEVNULL)
+	try:
+		while True:
+			buf = proc.stdout.read(block_size * frame_size)
+			block = np.frombuffer(buf, dtype = raw_dtype, count = len(buf) // frame_size * num_channels).reshape(-1, num_channels)
+			if len(block) == 0:
+				break
+			yield block
+	finally:
+		proc.kill()
+		proc.wait()
+
+
+def convert_signal(signal, sample_rate_, sample_rate, mono = True, dtype = 'float32', begin = 0, end = None, signal_begin = 0, num_frames = None):
+	# signal shaped TC at sample_rate_ -> tensor shaped CT at sample_rate, see resample for the window arguments
 	assert signal.dtype in [np.int16, np.float32]
 	signal = signal.T
 	
 	if signal.dtype == np.int16 and dtype == 'float32':
 		signal = s2f_numpy(signal)
+	elif signal.dtype == np.float32 and dtype == 'int16':
+		signal = f2s_numpy(np.clip(signal, -1, 1))
 	
 	if mono and len(signal) > 1:
-		assert signal.dtype == np.float32
-		signal = signal.mean(0, keepdims = True)
+		signal = signal.mean(0, keepdims = True, dtype = np.float32).astype(signal.dtype)
 
-	signal = torch.as_tensor(signal)
+	# read-only memory-mapped views are copied here, no earlier conversion copied them
+	signal = torch.as_tensor(signal if signal.flags.writeable else np.array(signal))
 
 	if sample_rate is not None and sample_rate_ != sample_rate:
-		signal, sample_rate_ = resample(signal, sample_rate_, sample_rate)
+		if signal.dtype == torch.int16:
+			signal, sample_rate_ = resample(signal.to(torch.float32), sample_rate_, sample_rate, begin = begin, end = end, signal_begin = signal_begin, num_frames = num_frames)
+			signal = signal.round_().clamp_(-smax - 1, smax).to(torch.int16)
+		else:
+			signal, sample_rate_ = resample(signal, sample_rate_, sample_rate, begin = begin, end = end, signal_begin = signal_begin, num_frames = num_frames)
 
 	return signal, sample_rate_
 
 
+def probe_num_channels(audio_path, backend = None):
+	if backend == 'sox':
+		return int(subprocess.check_output(['soxi', '-V0', '-c', audio_path]))
+
+	return int(
+		subprocess.check_output([
+			'ffprobe',
+			'-i',
+			audio_path,
+			'-show_entries',
+			'stream=channels',
+			'-select_streams',
+			'a:0',
+			'-of',
+			'compact=p=0:nk=1',
+			'-v',
+			'0'
+		])
+	)
+
+
+def decoder_cmd(audio_path, backend, sample_rate, num_channels, raw_dtype = 'int16', byte_order = 'little', begin = 0, end = None):
+	# command decoding [begin, end) frames of audio_path to raw frames on stdout
+	# the decoder seeks in the input to whole seconds a margin before begin, so that decoder and resampler transients settle
+	# before the window, then trims by sample count: a whole second is a whole number of frames at any sample rate, so the
+	# window is a sample-exact slice of the full decode (given exact timestamps after seeking) without decoding the prefix
+	seek = max(0, begin // sample_rate - 1) if begin else 0
+	begin, end = begin - seek * sample_rate, end - seek * sample_rate if end is not None else None
+	if backend == 'sox':
+		params_fmt = ['-b', '16', '-e', 'signed'] if raw_dtype == 'int16' else ['-b', '32', '-e', 'float']
+		# trim as the first effect makes sox seek in the input
+		params_seek = ['trim', str(seek)] if seek else []
+		params_trim = (['trim', f'{begin}s'] + ([f'{max(0, end - begin)}s'] if end is not None else [])) if begin or end is not None else []
+		return [
+			'sox',
+			'-V0',
+			audio_path
+			] + params_fmt +[
+			'--endian',
+			byte_order,
+			'-r',
+			str(sample_rate),
+			'-c',
+			str(num_channels),
+			'-t',
+			'raw',
+			'-'
+			] + params_seek + [
+			'channels',
+			str(num_channels),
+			'rate',
+			str(sample_rate)
+		] + params_trim
+
+	params_fmt = ['-f', 's16le'] if raw_dtype == 'int16' else ['-f', 'f32le']
+	params_trim = (f',atrim=start_sample={begin}' + (f':end_sample={end}' if end is not None else '')) if begin or end is not None else ''
+	params_seek = ['-ss', str(seek)] if seek else []
+	return [
+		'ffmpeg'] + params_seek + [
+		'-i',
+		audio_path,
+		'-nostdin',
+		'-hide_banner',
+		'-nostats',
+		'-loglevel',
+		'quiet',
+		'-af',
+		f'aresample={sample_rate}' + params_trim] + params_fmt + [
+		'-ar',
+		str(sample_rate),
+		'-ac',
+		str(num_channels),
+		'-'
+	]
+
+
+def read_wav_header(audio_path):
+	'''
+	Parse RIFF header of a PCM wav file:
+		* sample_rate
+		* num_channels
+		* dtype
+		* data_offset (in bytes)
+		* num_frames
+	'''
+	with open(audio_path, 'rb') as f:
+		riff, _, wave_ = struct.unpack('<4sI4s', f.read(12))
+		assert riff == b'RIFF' and wave_ == b'WAVE', f'Not a RIFF wav file [{audio_path}]'
+		while True:
+			chunk_header = f.read(8)
+			assert len(chunk_header) == 8, f'Data chunk not found [{audio_path}]'
+			chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+			if chunk_id == b'fmt ':
+				fmt = f.read(chunk_size + chunk_size % 2)
+				format_tag, num_channels, sample_rate, _, block_align, bits_per_sample = struct.unpack('<HHIIHH', fmt[:16])
+				if format_tag == 0xFFFE:
+					# WAVE_FORMAT_EXTENSIBLE stores actual format tag in the first bytes of the subformat GUID
+					format_tag, = struct.unpack('<H', fmt[24:26])
+			elif chunk_id == b'data':
+				data_offset = f.tell()
+				break
+			else:
+				f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+	# dtype is None for formats that cannot be memory-mapped as is (e.g. 24-bit PCM)
+	dtype = {(1, 16): '<i2', (3, 32): '<f4'}.get((format_tag, bits_per_sample))
+	# streamed wav files may have a bogus data chunk size, so it is bounded by file size
+	num_frames = min(chunk_size, os.path.getsize(audio_path) - data_offset) // block_align
+	return sample_rate, num_channels, dtype, data_offset, num_frames
+
+
+def frame_range(offset, duration, sample_rate):
+	# frame indices of [offset, offset + duration) as if the whole signal was sliced after decoding
+	begin = int(offset * sample_rate) if offset else 0
+	end = int((offset + duration) * sample_rate) if duration is not None else None
+	return begin, end
+
+
+def resample_frame_range(offset, duration, sample_rate_, sample_rate):
+	# frames [begin, end) of the signal resampled to sample_rate and frames [begin_, end_) at sample_rate_ needed to compute them
+	# exactly as if the whole signal was resampled, i.e. including the resampling filter context
+	if sample_rate is None or sample_rate_ == sample_rate:
+		begin, end = frame_range(offset, duration, sample_rate_)
+		return begin, end, begin, end
+	kernel, width, orig_freq, new_freq = sinc_resample_kernel(sample_rate_, sample_rate)
+	begin, end = frame_range(offset, duration, sample_rate)
+	return begin, end, max(0, begin // new_freq * orig_freq - width), -(-end // new_freq) * orig_freq + width if end is not None else None
+
+
+def read_audio_shard(shard_path, shard_offset, num_frames, num_channels, shard_sample_rate, sample_rate, offset = 0, duration = None, mono = True, dtype = 'float32'):
+	# shards are written by `tools.py pack`: headerless interleaved int16 frames of many files, shard_offset is in bytes
+	begin, end, begin_, end_ = resample_frame_range(offset, duration, shard_sample_rate, sample_rate)
+	end_ = num_frames if end_ is None else min(end_, num_frames)
+	begin_ = min(begin_, end_)
+	if end_ > begin_:
+		signal = np.memmap(shard_path, dtype = '<i2', mode = 'r', offset = shard_offset + 2 * num_channels * begin_, shape = (end_ - begin_, num_channels))
+	else:
+		signal = np.empty(shape = (0, num_channels), dtype = np.int16)
+	return convert_signal(signal, shard_sample_rate, sample_rate, mono = mono, dtype = dtype, begin = begin, end = end, signal_begin = begin_, num_frames = num_frames)
+
+
 def write_audio(audio_path, signal, sample_rate, mono = False, backend = None, format = 'wav'):
 	assert backend in [None, 'scipy', 'soundfile']
 	assert signal.dtype == torch.float32 or len(signal) == 1 or (not mono)
@@ -147,23 +387,51 @@ def write_audio(audio_path, signal, sample_rate, mono = False, backend = None, f
 		return audio_path
 
 
-def resample(signal, sample_rate_, sample_rate):
+@functools.lru_cache(maxsize = None)
+def sinc_resample_kernel(orig_freq, new_freq, lowpass_filter_width = 6, rolloff = 0.99):
+	# windowed sinc polyphase filter bank, one phase per output frame of a period, same design as torchaudio.functional.resample
+	gcd = math.gcd(orig_freq, new_freq)
+	orig_freq, new_freq = orig_freq // gcd, new_freq // gcd
+	base_freq = min(orig_freq, new_freq) * rolloff
+	width = math.ceil(lowpass_filter_width * orig_freq / base_freq)
+	idx = torch.arange(-width, width + orig_freq, dtype = torch.float64)[None, None] / orig_freq
+	t = (torch.arange(0, -new_freq, -1, dtype = torch.float64)[:, None, None] / new_freq + idx) * base_freq
+	t = t.clamp_(-lowpass_filter_width, lowpass_filter_width)
+	window = torch.cos(t * math.pi / lowpass_filter_width / 2) ** 2
+	t *= math.pi
+	kernel = torch.where(t == 0, torch.ones_like(t), t.sin() / t) * window * (base_freq / orig_freq)
+	return kernel.to(torch.float32), width, orig_freq, new_freq
+
+
+def resample(signal, sample_rate_, sample_rate, begin = 0, end = None, signal_begin = 0, num_frames = None):
+	# signal shaped CT, all channels are resampled with a single conv1d call; signal may hold only frames starting at signal_begin
+	# of a num_frames long signal and covering the range given by resample_frame_range, then only frames [begin, end) of the
+	# whole resampled signal are computed
 	assert signal.dtype == torch.float32
-	mono = len(signal) == 1
-	if mono:
-		signal = signal.squeeze(0)
-	# librosa does not like mono 1T signals
-	signal = torch.as_tensor(librosa.resample(signal.numpy(), sample_rate_, sample_rate))
-	if mono:
-		signal = signal.unsqueeze(0)
-	return signal, sample_rate
+	kernel, width, orig_freq, new_freq = sinc_resample_kernel(sample_rate_, sample_rate)
+	num_channels, length = signal.shape
+	num_frames = signal_begin + length if num_frames is None else num_frames
+	num_frames_resampled = int(math.ceil(new_freq * num_frames / orig_freq))
+	end = num_frames_resampled if end is None else min(end, num_frames_resampled)
+	begin = min(begin, end)
+	if begin == end:
+		return signal.new_zeros(num_channels, 0), sample_rate
+	# output frames [m * new_freq, (m + 1) * new_freq) are computed from input frames [m * orig_freq - width, (m + 1) * orig_freq + width),
+	# frames outside of the signal are zeros
+	m_begin, m_end = begin // new_freq, -(-end // new_freq)
+	padded = F.pad(signal.unsqueeze(1), (signal_begin - m_begin * orig_freq + width, m_end * orig_freq + width - signal_begin - length))
+	resampled = F.conv1d(padded, kernel.to(signal.device), stride = orig_freq).transpose(1, 2).reshape(num_channels, -1)
+	return resampled[..., begin - m_begin * new_freq : end - m_begin * new_freq].contiguous(), sample_rate
 
 def is_audio(audio_path):
 	extension = os.path.splitext(audio_path)[-1].lower()
 	return extension in AUDIO_FILE_EXTENSIONS
 
 def compute_duration(audio_path, backend = None):
-	assert backend in [None, 'scipy', 'ffmpeg', 'sox']
+	assert backend in [None, 'scipy', 'ffmpeg', 'sox', 'pyav']
+
+	if backend is None and AudioMetaCache.default() is not None:
+		return AudioMetaCache.default().extract_meta(audio_path)['duration']
 
 	if backend is None:
 		if audio_path.endswith('.wav'):
@@ -172,8 +440,9 @@ def compute_duration(audio_path, backend = None):
 			backend = 'ffmpeg'
 
 	if backend == 'scipy':
-		signal, sample_rate = read_audio(audio_path, sample_rate = None, dtype = None, mono = False, backend = 'scipy')
-		return signal.shape[-1] / sample_rate
+		# only the RIFF header is read
+		sample_rate, num_channels, dtype, data_offset, num_frames = read_wav_header(audio_path)
+		return num_frames / sample_rate
 
 	elif backend == 'ffmpeg':
 		cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of',
@@ -184,13 +453,19 @@ def compute_duration(audio_path, backend = None):
 		cmd = ['soxi', '-D']
 		return float(subprocess.check_output(cmd + [audio_path]))
 
+	elif backend == 'pyav':
+		return extract_meta(audio_path, backend = 'pyav')['duration']
+
 def extract_meta(audio_path, backend = None):
 	'''
 	Exctact metadata from audio:
 		* num_channels
 		* duration
 	'''
-	assert backend in [None, 'ffmpeg', 'wave']
+	assert backend in [None, 'ffmpeg', 'wave', 'pyav']
+
+	if backend is None and AudioMetaCache.default() is not None:
+		return AudioMetaCache.default().extract_meta(audio_path)
 
 	if backend is None:
 		if audio_path.endswith('.wav'):
@@ -212,18 +487,148 @@ def extract_meta(audio_path, backend = None):
 				num_channels = 0,
 				duration     = 0.0
 			)
-	elif backend == 'wave':
-		with wave.open(audio_path, 'r') as w:
-			nframes = w.getnframes()
-			nchannels = w.getnchannels()
-			duration = nframes / w.getframerate()
+	elif backend == 'pyav':
+		import av
+		with av.open(audio_path) as container:
+			stream = container.streams.audio[0]
 			metadata = dict(
-				num_channels = nchannels,
-				duration     = duration
+				num_channels = stream.channels,
+				duration     = float(stream.duration * stream.time_base) if stream.duration is not None else container.duration / av.time_base
 			)
+	elif backend == 'wave':
+		# RIFF header parsing instead of wave module, which rejects float and extensible wav files
+		sample_rate, num_channels, dtype, data_offset, num_frames = read_wav_header(audio_path)
+		metadata = dict(
+			num_channels = num_channels,
+			duration     = num_frames / sample_rate
+		)
 
 	return metadata
 
+
+class AudioMetaCache:
+	'''
+	Persistent cache of extract_meta results in an sqlite file, entries are keyed by (audio_path, size, mtime) and
+	become stale when the file changes. When initialized with init_default, compute_duration and extract_meta
+	without an explicit backend go through it.
+	'''
+	__instance = None
+
+	def __init__(self, cache_path, num_workers = 16):
+		self.cache_path = cache_path
+		self.num_workers = num_workers
+		self.connection = None
+		self.pid = None
+
+	@classmethod
+	def init_default(cls, cache_path, **kwargs):
+		cls.__instance = cls(cache_path, **kwargs) if cache_path else None
+
+	@classmethod
+	def default(cls):
+		return cls.__instance
+
+	def connect(self):
+		# sqlite connections must not be shared with forked processes
+		if self.connection is None or self.pid != os.getpid():
+			self.connection = sqlite3.connect(self.cache_path, timeout = 60)
+			self.connection.execute('CREATE TABLE IF NOT EXISTS meta (audio_path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, num_channels INTEGER, duration REAL)')
+			self.pid = os.getpid()
+		return self.connection
+
+	def get(self, audio_path):
+		stat = os.stat(audio_path)
+		row = self.connect().execute('SELECT num_channels, duration FROM meta WHERE audio_path = ? AND size = ? AND mtime_ns = ?', (audio_path, stat.st_size, stat.st_mtime_ns)).fetchone()
+		return dict(num_channels = row[0], duration = row[1]) if row is not None else None
+
+	def extract_meta(self, audio_path):
+		metadata = self.get(audio_path)
+		if metadata is None:
+			self.populate([audio_path])
+			metadata = self.get(audio_path)
+		if metadata is None:
+			raise RuntimeError(f'Failed to probe [{audio_path}]')
+		return metadata
+
+	def populate(self, audio_paths):
+		# probing is I/O and subprocess bound, so threads are enough to run it in parallel
+		missing = [audio_path for audio_path in set(audio_paths) if self.get(audio_path) is None]
+		if not missing:
+			return
+		with multiprocessing.pool.ThreadPool(processes = min(self.num_workers, len(missing))) as pool:
+			rows = pool.map(AudioMetaCache.probe, missing)
+		# failed probes are not cached, so that they are retried and reported by extract_meta
+		with self.connect() as connection:
+			connection.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?, ?, ?, ?)', [row for row in rows if row is not None])
+
+	@staticmethod
+	def probe(audio_path):
+		# returns None if the file cannot be probed, ffprobe output that cannot be parsed has zero channels
+		try:
+			stat = os.stat(audio_path)
+			metadata = extract_meta(audio_path, backend = 'wave' if audio_path.endswith('.wav') else 'ffmpeg')
+		except Exception:
+			print(f'Error when probing [{audio_path}]')
+			return None
+		if metadata['num_channels'] == 0:
+			return None
+		return (audio_path, stat.st_size, stat.st_mtime_ns, metadata['num_channels'], metadata['duration'])
+
+class DecodedAudioCache:
+	'''
+	Process local LRU cache of whole decoded signals bounded by a byte budget, keyed by (audio_path, sample_rate, mono, dtype, backend),
+	so that segments of the same recording are sliced from memory. Recordings that would not fit the budget are not decoded whole,
+	only the requested window is read. Hit and miss counts live in shared memory created by init_default, so that counts of
+	forked DataLoader workers are visible to the parent process.
+	'''
+	__instance = None
+
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.num_bytes = 0
+		self.signals = collections.OrderedDict()
+		self.counts = multiprocessing.Array('q', 2)
+
+	@classmethod
+	def init_default(cls, max_bytes, **kwargs):
+		cls.__instance = cls(max_bytes, **kwargs) if max_bytes else None
+
+	@classmethod
+	def default(cls):
+		return cls.__instance
+
+	def read_audio(self, audio_path, sample_rate, offset = 0, duration = None, mono = True, dtype = 'float32', backend = None):
+		key = (audio_path, sample_rate, mono, dtype, backend)
+		hit = key in self.signals
+		with self.counts.get_lock():
+			self.counts[0 if hit else 1] += 1
+
+		if hit:
+			self.signals.move_to_end(key)
+			signal = self.signals[key]
+		else:
+			# decoded size is estimated from metadata, which goes through AudioMetaCache if it is enabled
+			metadata = extract_meta(audio_path)
+			num_bytes = math.ceil(metadata['duration'] * sample_rate) * (1 if mono else metadata['num_channels']) * np.dtype(dtype).itemsize
+			if num_bytes > self.max_bytes:
+				return read_audio(audio_path, sample_rate, offset = offset, duration = duration, mono = mono, dtype = dtype, backend = backend)
+
+			signal, sample_rate = read_audio(audio_path, sample_rate, mono = mono, dtype = dtype, backend = backend)
+			num_bytes = signal.numel() * signal.element_size()
+			if num_bytes <= self.max_bytes:
+				while self.num_bytes + num_bytes > self.max_bytes:
+					evicted = self.signals.popitem(last = False)[1]
+					self.num_bytes -= evicted.numel() * evicted.element_size()
+				self.signals[key] = signal
+				self.num_bytes += num_bytes
+
+		begin, end = frame_range(offset, duration, sample_rate)
+		return signal[:, begin:end], sample_rate
+
+	def stats(self):
+		hits, misses = self.counts[:]
+		return dict(audio_cache_hits = hits, audio_cache_misses = misses, audio_cache_hit_rate = hits / max(1, hits + misses))
+
 if __name__ == '__main__':
 	import argparse
 	import time
@@ -242,21 +647,85 @@ if __name__ == '__main__':
 	cmd.add_argument('--scale', type=int, default=1000)
 	cmd.add_argument('--raw-dtype', default='int16', choices=['int16', 'float32'])
 	cmd.add_argument('--dtype', default='float32', choices=['int16', 'float32'])
+	cmd.add_argument('--offset', type=float, default=0)
+	cmd.add_argument('--duration', type=float, default=None)
 	cmd.set_defaults(func='timeit')
 
+	cmd = subparsers.add_parser('timeit-windows')
+	cmd.add_argument('--audio-path', type=str, required=True)
+	cmd.add_argument('--sample-rate', type=int, default=8000)
+	cmd.add_argument('--audio-backend', type=str, nargs='+', default=['ffmpeg', 'sox', 'pyav', 'soundfile'])
+	cmd.add_argument('--offset-fraction', type=float, nargs='+', default=[0.0, 0.5, 0.9])
+	cmd.add_argument('--duration', type=float, default=10.0)
+	cmd.add_argument('--number', type=int, default=3)
+	cmd.set_defaults(func='timeit-windows')
+
+	cmd = subparsers.add_parser('resample')
+	cmd.add_argument('--orig-sample-rate', type=int, nargs='+', default=[48000, 16000])
+	cmd.add_argument('--sample-rate', type=int, default=8000)
+	cmd.add_argument('--num-channels', type=int, default=2)
+	cmd.add_argument('--duration', type=float, default=60.0)
+	cmd.add_argument('--number', type=int, default=10)
+	cmd.add_argument('--compare-librosa', action='store_true')
+	cmd.set_defaults(func='resample')
+
 	args = parser.parse_args()
 
 	if args.func == 'timeit':
 		utils.reset_cpu_threads(1)
 		for i in range(args.number_warmup):
-			read_audio(args.audio_path, sample_rate=args.sample_rate, mono=args.mono, backend=args.audio_backend, dtype=args.dtype, raw_dtype=args.raw_dtype)
+			read_audio(args.audio_path, sample_rate=args.sample_rate, mono=args.mono, backend=args.audio_backend, dtype=args.dtype, raw_dtype=args.raw_dtype, offset=args.offset, duration=args.duration)
 
 		start_process_time = time.process_time_ns()
 		start_perf_counter = time.perf_counter_ns()
 		for i in range(args.number):
-			read_audio(args.audio_path, sample_rate=args.sample_rate, mono=args.mono, backend=args.audio_backend, dtype=args.dtype, raw_dtype=args.raw_dtype)
+			read_audio(args.audio_path, sample_rate=args.sample_rate, mono=args.mono, backend=args.audio_backend, dtype=args.dtype, raw_dtype=args.raw_dtype, offset=args.offset, duration=args.duration)
 		end_process_time = time.process_time_ns()
 		end_perf_counter = time.perf_counter_ns()
 		process_time = (end_process_time - start_process_time) / args.scale / args.number
 		perf_counter = (end_perf_counter - start_perf_counter) / args.scale / args.number
-		print(f'|{args.audio_path:>20}|{args.number:>5}|{args.audio_backend:>10}|{process_time:9.0f}|{perf_counter:9.0f}|')
+		files_per_sec = args.number / ((end_perf_counter - start_perf_counter) * 1e-9)
+		print(f'|{args.audio_path:>20}|{args.number:>5}|{args.audio_backend:>10}|{process_time:9.0f}|{perf_counter:9.0f}|{files_per_sec:9.1f}|')
+
+	if args.func == 'timeit-windows':
+		# time of reading a window of the same duration at increasing offsets, flat for backends that seek instead of decoding the prefix
+		utils.reset_cpu_threads(1)
+		audio_duration = compute_duration(args.audio_path)
+		print('| backend | offset sec | window sec | msec per read |')
+		print('|---:|---:|---:|---:|')
+		for backend in args.audio_backend:
+			for offset_fraction in args.offset_fraction:
+				offset = offset_fraction * audio_duration
+				start_perf_counter = time.perf_counter_ns()
+				for i in range(args.number):
+					read_audio(args.audio_path, sample_rate=args.sample_rate, backend=backend, offset=offset, duration=args.duration)
+				end_perf_counter = time.perf_counter_ns()
+				print(f'|{backend:>10}|{offset:>9.1f}|{args.duration:>6.1f}|{(end_perf_counter - start_perf_counter) * 1e-6 / args.number:9.1f}|')
+
+	if args.func == 'resample':
+		utils.reset_cpu_threads(1)
+		print('| resampling | channels | duration sec | realtime factor | max abs diff with librosa |')
+		print('|-----------:|---:|---:|---:|---:|')
+		for orig_sample_rate in args.orig_sample_rate:
+			# band-limited test signal: sum of tones below the target Nyquist frequency
+			t = torch.arange(int(args.duration * orig_sample_rate), dtype=torch.float64) / orig_sample_rate
+			signal = sum(torch.sin(2 * math.pi * f * t + c) for c in range(args.num_channels) for f in [300.0, 1000.0, 2500.0])
+			signal = (0.1 * signal / args.num_channels).to(torch.float32).expand(args.num_channels, -1).contiguous()
+
+			resampled, _ = resample(signal, orig_sample_rate, args.sample_rate)
+			start_perf_counter = time.perf_counter_ns()
+			for i in range(args.number):
+				resampled, _ = resample(signal, orig_sample_rate, args.sample_rate)
+			end_perf_counter = time.perf_counter_ns()
+			realtime_factor = args.duration * args.number / ((end_perf_counter - start_perf_counter) * 1e-9)
+
+			max_abs_diff = float('nan')
+			if args.compare_librosa:
+				import librosa
+				resampled_librosa = torch.as_tensor(librosa.resample(signal.numpy(), orig_sr = orig_sample_rate, target_sr = args.sample_rate))
+				# edges are excluded, filters of different length disagree there
+				margin = args.sample_rate // 10
+				size = min(resampled.shape[-1], resampled_librosa.shape[-1])
+				max_abs_diff = float((resampled[..., margin:size - margin] - resampled_librosa[..., margin:size - margin]).abs().max())
+
+			print(f'|{orig_sample_rate:>6}->{args.sample_rate:<6}|{args.num_channels:>3}|{args.duration:>6.0f}|{realtime_factor:9.0f}|{max_abs_diff:9.5f}|')
@@ -1,7 +1,10 @@
 import gc
+import copy
+import json
 import math
 import argparse
 import time
+import resource
 import torch
 import torch.cuda.profiler
 import apex
@@ -9,6 +12,8 @@ import onnxruntime
 import models
 import datasets
 import utils
+import text_processing
+import inference
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--checkpoint')
@@ -36,6 +41,15 @@ parser.add_argument('--profile-cuda', action = 'store_true')
 parser.add_argument('--profile-autograd')
 parser.add_argument('--data-parallel', action = 'store_true')
 parser.add_argument('--backward', action = 'store_true')
+parser.add_argument('--activation-checkpointing', type = lambda x: x if x == 'block' else int(x), help = 'same as in train.py, use with --backward')
+parser.add_argument('--lengths-fraction', type = float, help = 'pass random lengths fractions from [lengths_fraction, 1], so that temporal masks are applied')
+parser.add_argument('--streaming-chunk', type = float, help = 'in seconds, compare log probs and per chunk latency of streaming forward with offline forward')
+parser.add_argument('--quantize', action = 'store_true', help = 'int8 static quantization of conv stacks, CPU only, requires --checkpoint')
+parser.add_argument('--quantize-calibration-data-path', nargs = '+', default = [], help = 'manifests for calibration of activation ranges')
+parser.add_argument('--quantize-calibration-batches', type = int, default = 16)
+parser.add_argument('--quantize-val-data-path', nargs = '+', default = [], help = 'manifests to compare CER of fp32 and int8 models on')
+parser.add_argument('--quantize-batch-size', type = int, default = 8)
+parser.add_argument('--compare-temporal-mask-cache', action = 'store_true', help = 'compare forward latency and outputs with temporal masks recomputed in every layer and cached per forward')
 args = parser.parse_args()
 
 checkpoint = torch.load(args.checkpoint, map_location = 'cpu') if args.checkpoint else None
@@ -48,7 +62,7 @@ labels = datasets.Labels(datasets.Language(args.lang))
 
 if args.onnx:
 	onnxruntime_session = onnxruntime.InferenceSession(args.onnx)
-	model = lambda x: onnxruntime_session.run(None, dict(x = x))
+	model = lambda x, xlen = None: onnxruntime_session.run(None, dict(x = x))
 	load_batch = lambda x: x.numpy()
 
 else:
@@ -71,10 +85,31 @@ else:
 	if checkpoint:
 		model.load_state_dict(checkpoint['model_state_dict'])
 	model.to(args.device)
+	model.set_activation_checkpointing(args.activation_checkpointing)
 
 	if not args.backward:
 		model.eval()
 		model.fuse_conv_bn_eval()
+	jasper_net = model
+
+	if args.quantize:
+		assert checkpoint and not args.backward and not args.data_parallel and not use_cuda, '--quantize requires --checkpoint and a CPU forward-only run'
+		assert args.quantize_calibration_data_path, '--quantize requires --quantize-calibration-data-path'
+		text_pipeline = text_processing.ProcessingPipeline.make(json.load(open(checkpoint['args']['text_config'])), checkpoint['args'].get('text_pipelines', ['char_legacy'])[0])
+		# features are computed by the dataset unless the frontend is a part of the model
+		make_data_loader = lambda data_paths: inference.calibration_data_loader(
+			data_paths, text_pipeline, args.sample_rate,
+			frontend = models.LogFilterBankFrontend(args.num_input_features, args.sample_rate, args.window_size, args.window_stride, args.window) if not args.frontend else None,
+			batch_size = args.quantize_batch_size
+		)
+		fp32_model = copy.deepcopy(model)
+		inference.quantize(model, make_data_loader(args.quantize_calibration_data_path), num_batches = args.quantize_calibration_batches)
+		if args.quantize_val_data_path:
+			compared = inference.compare_quantized(fp32_model, model, make_data_loader(args.quantize_val_data_path), text_pipeline)
+			print('quantization: cer fp32 {:.02%} | cer int8 {:.02%} | cer delta {:+.02%} | speedup {:.02f}x on val data'.format(
+				compared['fp32']['cer'], compared['int8']['cer'], compared['int8']['cer'] - compared['fp32']['cer'], compared['fp32']['time_sec'] / compared['int8']['time_sec']
+			))
+			print()
 
 	model, *_ = models.data_parallel_and_autocast(model, opt_level = args.fp16) if args.data_parallel else (model, )
 	load_batch = lambda x: x.to(args.device, non_blocking = True)
@@ -88,7 +123,8 @@ if batch_shape[-1] % 128 != 0:
 example_time = batch_shape[-1] / args.sample_rate if args.frontend else batch_shape[-1] * args.window_stride
 
 batch = torch.rand(*batch_shape)
-batch = batch.pin_memory()
+batch = batch.pin_memory() if use_cuda else batch
+xlen = (torch.rand(args.B) * (1 - args.lengths_fraction) + args.lengths_fraction).to(args.device) if args.lengths_fraction else None
 
 print(args)
 print()
@@ -99,6 +135,68 @@ print(
 )
 print()
 
+if args.compare_temporal_mask_cache:
+	assert not args.onnx and xlen is not None, '--compare-temporal-mask-cache requires --lengths-fraction and a PyTorch model'
+	outputs, times = {}, {}
+	with torch.no_grad():
+		for cache_temporal_masks in [False, True]:
+			jasper_net.cache_temporal_masks = cache_temporal_masks
+			for i in range(args.iterations_warmup):
+				model(load_batch(batch), xlen)
+			tic = tictoc()
+			for i in range(args.iterations):
+				outputs[cache_temporal_masks] = model(load_batch(batch), xlen)
+			times[cache_temporal_masks] = (tictoc() - tic) / args.iterations
+	print('temporal masks: recomputed {:.02f} msec | cached {:.02f} msec | max abs diff {:.02e}'.format(
+		times[False] * 1e3, times[True] * 1e3, float((outputs[False] - outputs[True]).abs().max())
+	))
+	print()
+
+if args.streaming_chunk:
+	assert not args.onnx and not args.data_parallel and not args.backward, '--streaming-chunk requires a PyTorch model in eval mode'
+	chunk_size = int(args.streaming_chunk * args.sample_rate) if args.frontend else int(args.streaming_chunk / args.window_stride)
+
+	def compare_streaming(x):
+		offline = torch.nn.functional.log_softmax(jasper_net(x), dim = 1)
+		chunks, times, state = [], [], None
+		chunk_begins = list(range(0, x.shape[-1], chunk_size))
+		for k, begin in enumerate(chunk_begins):
+			tic = tictoc()
+			(log_probs, ), state = jasper_net.forward_streaming(x[..., begin:begin + chunk_size], state, final = k == len(chunk_begins) - 1)
+			times.append(tictoc() - tic)
+			chunks.append(log_probs)
+		streaming = torch.cat(chunks, dim = -1)
+		assert streaming.shape == offline.shape, f'streaming output shape {tuple(streaming.shape)} differs from offline {tuple(offline.shape)}'
+		return float((streaming - offline).abs().max()), sum(times) / len(times)
+
+	normalize_features, normalize_signal = jasper_net.normalize_features, jasper_net.frontend is not None and jasper_net.frontend.normalize_signal
+	if (normalize_features is not None and not normalize_features.track_running_stats) or normalize_signal:
+		# streaming rejects per utterance normalization, both forwards are compared without it
+		print('streaming: per utterance normalization of signal and features is disabled for comparison')
+		jasper_net.normalize_features = normalize_features if normalize_features is not None and normalize_features.track_running_stats else None
+		if jasper_net.frontend is not None:
+			jasper_net.frontend.normalize_signal = False
+	with torch.no_grad():
+		max_abs_diff, chunk_time = compare_streaming(load_batch(batch))
+	print('streaming: chunk {:.02f} sec | {:.02f} msec per chunk | max abs diff of log probs {:.02e}'.format(args.streaming_chunk, chunk_time * 1e3, max_abs_diff))
+	jasper_net.normalize_features = normalize_features
+	if jasper_net.frontend is not None:
+		jasper_net.frontend.normalize_signal = normalize_signal
+	print()
+
+if args.quantize:
+	times = {}
+	with torch.no_grad():
+		for name, m in [('fp32', fp32_model), ('int8', model)]:
+			for i in range(args.iterations_warmup):
+				m(load_batch(batch), xlen)
+			tic = tictoc()
+			for i in range(args.iterations):
+				m(load_batch(batch), xlen)
+			times[name] = (tictoc() - tic) / args.iterations
+	print('quantization: fp32 {:.02f} msec | int8 {:.02f} msec | speedup {:.02f}x'.format(times['fp32'] * 1e3, times['int8'] * 1e3, times['fp32'] / times['int8']))
+	print()
+
 print('Warming up for', args.iterations_warmup, 'iterations')
 tic_wall = tictoc()
 if use_cuda:
@@ -106,7 +204,7 @@ if use_cuda:
 
 torch.set_grad_enabled(args.backward)
 for i in range(args.iterations_warmup):
-	y = model(load_batch(batch))
+	y = model(load_batch(batch), xlen)
 	if args.backward:
 		y.sum().backward()
 
@@ -126,9 +224,9 @@ tic_wall = tictoc()
 times_fwd, times_bwd, fragmentation = torch.zeros(args.iterations), torch.zeros(args.iterations), torch.zeros(args.iterations)
 for i in range(args.iterations):
 	tic = tictoc()
-	y = model(load_batch(batch))
+	y = model(load_batch(batch), xlen)
 	toc = tictoc()
-	fragmentation[i] = utils.compute_memory_fragmentation()
+	fragmentation[i] = utils.compute_memory_fragmentation() if use_cuda else 0
 	if args.backward:
 		y.sum().backward()
 	tac = tictoc()
@@ -138,6 +236,8 @@ for i in range(args.iterations):
 
 mem_reserved = torch.cuda.max_memory_reserved(args.device) if use_cuda else 0
 mem_allocated = torch.cuda.max_memory_allocated(args.device) if use_cuda else 0
+# peak resident set size of the process, on Linux ru_maxrss is in kilobytes
+mem_cpu_max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
 print('Benchmark done in {:.02f} wall clock seconds'.format(tictoc() - tic_wall))
 print()
 
@@ -146,12 +246,13 @@ if args.profile_autograd:
 	autograd_profiler.export_chrome_trace(args.profile_autograd)
 
 print(
-	'load+fwd {:.02f} msec | bwd {:.02f} msec | cudamemreserved {:.02f} mb | cudamemallocated {:.02f} mb | cudamemutilization: {:.02f}'
+	'load+fwd {:.02f} msec | bwd {:.02f} msec | cudamemreserved {:.02f} mb | cudamemallocated {:.02f} mb | cudamemutilization: {:.02f} | cpumaxrss {:.02f} mb'
 	.format(
 		float(times_fwd.mean()) * 1e3,
 		float(times_bwd.mean()) * 1e3,
 		mem_reserved * 1e-6,
 		mem_allocated * 1e-6,
-		float(fragmentation.mean())
+		float(fragmentation.mean()),
+		mem_cpu_max_rss * 1e-6
 	)
 )
@@ -3,6 +3,12 @@ import typing
 import math
 import time
 import itertools
+import hashlib
+import json
+import array
+import multiprocessing
+import sqlite3
+import numpy as np
 import text_processing
 import importlib
 import torch.utils.data
@@ -11,7 +17,11 @@ import audio
 import utils
 import transcripts
 import shaping
-import operator
+import queue
+import threading
+import collections
+import concurrent.futures
+import bisect
 import typing
 import torch.nn.functional as F
 
@@ -31,10 +41,11 @@ class AudioTextDataset(torch.utils.data.Dataset):
 	? {"channel" : 0}
 	? {"speaker" : 1 | "speaker1"}
 	Returned from __getitem__:
-	{"audio_path" : "/path/to/audi.ext", "ref" : "ref text", "example_id" : "example_id"}
+	{"audio_path" : "/path/to/audi.ext", "ref" : "ref text", "example_id" : 0}
 	Returned from get_meta:
-	{"audio_path" : "/path/to/audio.ext", "example_id" : "example_id", "begin" : 0.0 | time_missing, "end" : 0.0 | time_misisng, "channel" : 0 | 1 | channel_missing, "speaker" : 1 | 15 | speaker_missing, "meta" : original_example, "ref" : 'ref or empty before normalization'}
+	{"audio_path" : "/path/to/audio.ext", "example_id" : 0, "begin" : 0.0 | time_missing, "end" : 0.0 | time_misisng, "channel" : 0 | 1 | channel_missing, "speaker" : 1 | 15 | speaker_missing, "speaker_name" : "speaker1", "ref" : 'ref or empty before normalization'}
 	Comments:
+	example_id is the integer index of a segment in the dataset columns, get_example_id formats its string form for output
 	If speaker_names are not set and speakers are not set, uses channel indices as speakers
 
 	channels note:
@@ -43,6 +54,7 @@ class AudioTextDataset(torch.utils.data.Dataset):
 	'''
 
 	DEFAULT_MODE = 'default'
+	INDEX_VERSION = 2
 	BATCHED_CHANNELS_MODE = 'batched_channels'
 	BATCHED_TRANSCRIPT_MODE = 'batched_transcript'
 
@@ -64,8 +76,10 @@ class AudioTextDataset(torch.utils.data.Dataset):
 			audio_backend: typing.Optional[str] = None,
 			exclude: typing.Optional[typing.Set] = None,
 			bucket_fn: typing.Callable[[typing.List[typing.Dict]], int] = lambda transcript: 0,
-			pop_meta: bool = False,
-			string_array_encoding: str = 'utf_16_le',
+			audio_shards: typing.Optional[str] = None,
+			feature_cache: typing.Optional[str] = None,
+			streaming: bool = False,
+			streaming_num_workers: int = 0,
 			_print: typing.Callable = print,
 			debug_short_long_records_features_from_whole_normalized_signal: bool = False
 	):
@@ -81,98 +95,203 @@ class AudioTextDataset(torch.utils.data.Dataset):
 		self.mono = mono
 		self.audio_backend = audio_backend
 		self.audio_dtype = audio_dtype
+		# seconds spent reading audio and number of reads, shared with forked DataLoader workers
+		self.read_audio_stats = multiprocessing.Array('d', 2)
 
 		data_paths = data_paths if isinstance(data_paths, list) else [data_paths]
 
-		tic = time.time()
-
-		segments = []
-		for path in data_paths:
-			if audio.is_audio(path):
-				assert self.mode != AudioTextDataset.DEFAULT_MODE, 'Audio files not allowed as dataset input in default mode'
-				if self.mono:
-					transcript = [dict(audio_path = path, channel = transcripts.channel_missing)]
+		# features are cached only if they are a deterministic function of the example and the frontend
+		self.feature_cache = None
+		if feature_cache is not None and frontend is not None:
+			if getattr(frontend, 'dither', 0.0) > 0 or getattr(frontend, 'dither0', 0.0) > 0:
+				_print('Feature cache disabled, because frontend dither is enabled')
+			else:
+				self.feature_cache = FeatureCache(feature_cache, FeatureCache.digest(frontend, mode = mode, sample_rate = sample_rate, mono = mono,
+				                                  audio_dtype = audio_dtype, max_duration = max_duration,
+				                                  debug_short_long_records_features_from_whole_normalized_signal = debug_short_long_records_features_from_whole_normalized_signal))
+
+		if streaming:
+			self.load_streaming(data_paths, text_pipelines, speaker_names = speaker_names, max_num_channels = max_num_channels,
+			                    min_duration = min_duration, max_duration = max_duration, max_audio_file_size = max_audio_file_size,
+			                    exclude = exclude, bucket_fn = bucket_fn, num_workers = streaming_num_workers, _print = _print)
+		else:
+			tic = time.time()
+
+			segments = []
+			for path in data_paths:
+				if audio.is_audio(path):
+					assert self.mode != AudioTextDataset.DEFAULT_MODE, 'Audio files not allowed as dataset input in default mode'
+					if self.mono:
+						transcript = [dict(audio_path = path, channel = transcripts.channel_missing)]
+					else:
+						transcript = [dict(audio_path = path, channel = c) for c in range(max_num_channels)]
 				else:
-					transcript = [dict(audio_path = path, channel = c) for c in range(max_num_channels)]
+					transcript = transcripts.load(path)
+				segments.extend(transcript)
+
+			_print('Dataset reading time: ', time.time() - tic)
+			tic = time.time()
+
+			# get_or_else required because dictionary could contain None values which we want to replace.
+			# dict.get doesnt work in this case
+			get_or_else = lambda dictionary, key, default: dictionary[key] if dictionary.get(key) is not None else default
+			for t in segments:
+				t['ref'] = get_or_else(t, 'ref', transcripts.ref_missing)
+				t['begin'] = get_or_else(t, 'begin', transcripts.time_missing)
+				t['end'] = get_or_else(t, 'end', transcripts.time_missing)
+				t['channel'] = get_or_else(t, 'channel', transcripts.channel_missing) if not self.mono else transcripts.channel_missing
+
+			transcripts.collect_speaker_names(segments, speaker_names = speaker_names or [], num_speakers = max_num_channels, set_speaker_data = True)
+
+			if self.mode == AudioTextDataset.BATCHED_CHANNELS_MODE and audio.AudioMetaCache.default() is not None:
+				# probe durations of all uncached files at once instead of one subprocess per file in join_transcript
+				audio.AudioMetaCache.default().populate([t['audio_path'] for t in segments])
+
+			buckets = []
+			grouped_segments = []
+			transcripts_len = []
+			speakers_len = []
+			if self.mode == AudioTextDataset.DEFAULT_MODE:
+				groupped_transcripts = ((i, [t]) for i, t in enumerate(segments))
 			else:
-				transcript = transcripts.load(path)
-			segments.extend(transcript)
-
-		_print('Dataset reading time: ', time.time() - tic)
-		tic = time.time()
+				groupped_transcripts = itertools.groupby(sorted(segments, key = transcripts.group_key), transcripts.group_key)
 
-		# get_or_else required because dictionary could contain None values which we want to replace.
-		# dict.get doesnt work in this case
-		get_or_else = lambda dictionary, key, default: dictionary[key] if dictionary.get(key) is not None else default
-		for t in segments:
-			t['ref'] = get_or_else(t, 'ref', transcripts.ref_missing)
-			t['begin'] = get_or_else(t, 'begin', transcripts.time_missing)
-			t['end'] = get_or_else(t, 'end', transcripts.time_missing)
-			t['channel'] = get_or_else(t, 'channel', transcripts.channel_missing) if not self.mono else transcripts.channel_missing
-
-		transcripts.collect_speaker_names(segments, speaker_names = speaker_names or [], num_speakers = max_num_channels, set_speaker_data = True)
-
-		buckets = []
-		grouped_segments = []
-		transcripts_len = []
-		speakers_len = []
-		if self.mode == AudioTextDataset.DEFAULT_MODE:
-			groupped_transcripts = ((i, [t]) for i, t in enumerate(segments))
-		else:
-			groupped_transcripts = itertools.groupby(sorted(segments, key = transcripts.group_key), transcripts.group_key)
+			for group_key, transcript in groupped_transcripts:
+				transcript = sorted(transcript, key = transcripts.sort_key)
+				if self.mode == AudioTextDataset.BATCHED_CHANNELS_MODE:
+					transcript = transcripts.join_transcript(transcript, self.mono)
 
-		for group_key, transcript in groupped_transcripts:
-			transcript = sorted(transcript, key = transcripts.sort_key)
+				if exclude is not None:
+					allowed_audio_names = set(transcripts.audio_name(t) for t in transcript if transcripts.audio_name(t) not in exclude)
+				else:
+					allowed_audio_names = None
+
+				transcript = transcripts.prune(transcript,
+				                               allowed_audio_names = allowed_audio_names,
+				                               duration = (min_duration if min_duration is not None else 0.0,
+				                                           max_duration if max_duration is not None else 24.0 * 3600,), #24h
+				                               max_audio_file_size = max_audio_file_size)
+				transcript = list(transcript)
+				if len(transcript) == 0:
+					continue
+
+				bucket = bucket_fn(transcript)
+				for t in transcript:
+					t['bucket'] = bucket
+					speakers_len.append(len(t['speaker']) if (isinstance(t['speaker'], list)) else 1)
+				buckets.append(bucket)
+				grouped_segments.extend(transcript)
+				transcripts_len.append(len(transcript))
+
+
+			_print('Dataset construction time: ', time.time() - tic)
+			tic = time.time()
+
+			self.bucket = torch.tensor(buckets, dtype = torch.short)
+			self.audio_path = utils.TensorBackedStringArray([t['audio_path'] for t in grouped_segments])
+			self.ref = utils.TensorBackedStringArray([t['ref'] for t in grouped_segments])
+			self.begin = torch.tensor([t['begin'] for t in grouped_segments], dtype = torch.float64)
+			self.end = torch.tensor([t['end'] for t in grouped_segments], dtype = torch.float64)
+			self.channel = torch.tensor([t['channel'] for t in grouped_segments], dtype = torch.int8)
+			self.speaker_name = utils.TensorBackedStringArray([t.get('speaker_name') or transcripts.speaker_name_missing for t in grouped_segments])
 			if self.mode == AudioTextDataset.BATCHED_CHANNELS_MODE:
-				transcript = transcripts.join_transcript(transcript, self.mono)
-
-			if exclude is not None:
-				allowed_audio_names = set(transcripts.audio_name(t) for t in transcript if transcripts.audio_name(t) not in exclude)
+				self.speaker = torch.tensor([speaker for t in grouped_segments for speaker in t['speaker']], dtype = torch.int64)
 			else:
-				allowed_audio_names = None
-
-			transcript = transcripts.prune(transcript,
-			                               allowed_audio_names = allowed_audio_names,
-			                               duration = (min_duration if min_duration is not None else 0.0,
-			                                           max_duration if max_duration is not None else 24.0 * 3600,), #24h
-			                               max_audio_file_size = max_audio_file_size)
-			transcript = list(transcript)
-			for t in transcript:
-				t['example_id'] = AudioTextDataset.get_example_id(t)
-
-			if len(transcript) == 0:
-				continue
-
-			bucket = bucket_fn(transcript)
-			for t in transcript:
-				t['bucket'] = bucket
-				speakers_len.append(len(t['speaker']) if (isinstance(t['speaker'], list)) else 1)
-			buckets.append(bucket)
-			grouped_segments.extend(transcript)
-			transcripts_len.append(len(transcript))
+				self.speaker = torch.tensor([t['speaker'] for t in grouped_segments], dtype = torch.int64)
+			self.speaker_len = torch.tensor(speakers_len, dtype = torch.int16)
+			self.transcript_cumlen = torch.tensor(transcripts_len, dtype = torch.int16).cumsum(dim = 0, dtype = torch.int64)
+			_print('Dataset tensors creation time: ', time.time() - tic)
+			tic = time.time()
+
+			# refs never change, so targets of every text pipeline are encoded once and stored ragged: flat values and cumulative lengths
+			self.target, self.target_speaker, self.target_cumlen = [], [], []
+			segments_with_speaker_list = [dict(ref = t['ref'], speaker = t['speaker'] if isinstance(t['speaker'], list) else [t['speaker']]) for t in grouped_segments]
+			for pipeline in text_pipelines:
+				encoded_refs, aligned_speakers = AudioTextDataset.encode_transcript(segments_with_speaker_list, pipeline)
+				self.target.append(torch.cat(encoded_refs).to(torch.int32) if encoded_refs else torch.empty(0, dtype = torch.int32))
+				self.target_speaker.append(torch.cat(aligned_speakers).to(torch.int32) if aligned_speakers else torch.empty(0, dtype = torch.int32))
+				self.target_cumlen.append(torch.tensor(list(map(len, encoded_refs)), dtype = torch.int64).cumsum(dim = 0))
+			_print('Dataset targets encoding time: ', time.time() - tic)
 
+		tic = time.time()
+		# audio packed by `tools.py pack`, segments of files missing from the shards index are decoded with read_audio
+		self.audio_shard_paths, self.audio_shard_sample_rate = [], None
+		self.audio_shard = torch.empty(0, dtype = torch.int16)
+		self.audio_shard_offset = torch.empty(0, dtype = torch.int64)
+		self.audio_shard_length = torch.empty(0, dtype = torch.int64)
+		self.audio_shard_num_channels = torch.empty(0, dtype = torch.int8)
+		if audio_shards is not None:
+			index = torch.load(audio_shards)
+			row = {audio_path: i for i, audio_path in enumerate(index['audio_path'])}
+			rows = [row.get(audio_path) for audio_path in self.audio_path]
+			shard, offset, length, num_channels = [index[k].tolist() for k in ['shard', 'offset', 'length', 'num_channels']]
+			self.audio_shard_paths = [os.path.join(os.path.dirname(audio_shards), shard_path) for shard_path in index['shard_paths']]
+			self.audio_shard_sample_rate = index['sample_rate']
+			self.audio_shard = torch.tensor([shard[i] if i is not None else -1 for i in rows], dtype = torch.int16)
+			self.audio_shard_offset = torch.tensor([offset[i] if i is not None else 0 for i in rows], dtype = torch.int64)
+			self.audio_shard_length = torch.tensor([length[i] if i is not None else 0 for i in rows], dtype = torch.int64)
+			self.audio_shard_num_channels = torch.tensor([num_channels[i] if i is not None else 0 for i in rows], dtype = torch.int8)
+			_print('Dataset segments found in audio shards: ', int((self.audio_shard >= 0).sum()), 'of', len(rows))
+		_print('Dataset audio shards lookup time: ', time.time() - tic)
+
+	def load_streaming(self, data_paths, text_pipelines, speaker_names, max_num_channels, min_duration, max_duration, max_audio_file_size,
+	                   exclude, bucket_fn, num_workers, _print):
+		'''
+		Default mode construction that appends filtered segments of each manifest straight into columnar buffers instead of
+		building lists of dicts, manifests are parsed in a pool of forked processes if num_workers > 1
+		'''
+		assert self.mode == AudioTextDataset.DEFAULT_MODE, 'Streaming construction supports only default mode'
+		tic = time.time()
 
-		_print('Dataset construction time: ', time.time() - tic)
+		options = dict(text_pipelines = text_pipelines, mono = self.mono, max_audio_file_size = max_audio_file_size, exclude = exclude,
+		               duration = (min_duration if min_duration is not None else 0.0, max_duration if max_duration is not None else 24.0 * 3600),
+		               bucket_fn = bucket_fn)
+		if num_workers > 1 and len(data_paths) > 1:
+			# fork keeps bucket_fn and text pipelines from being pickled, only manifest paths and resulting columns are
+			with multiprocessing.get_context('fork').Pool(min(num_workers, len(data_paths)), initializer = init_columns_worker, initargs = (options, )) as pool:
+				columns = pool.map(load_columns, data_paths)
+		else:
+			init_columns_worker(options)
+			columns = list(map(load_columns, data_paths))
+		_print('Dataset streaming reading time: ', time.time() - tic)
 		tic = time.time()
 
-		self.bucket = torch.tensor(buckets, dtype = torch.short)
-		self.audio_path = utils.TensorBackedStringArray([t['audio_path'] for t in grouped_segments], encoding = string_array_encoding)
-		self.ref = utils.TensorBackedStringArray([t['ref'] for t in grouped_segments], encoding = string_array_encoding)
-		self.begin = torch.tensor([t['begin'] for t in grouped_segments], dtype = torch.float64)
-		self.end = torch.tensor([t['end'] for t in grouped_segments], dtype = torch.float64)
-		self.channel = torch.tensor([t['channel'] for t in grouped_segments], dtype = torch.int8)
-		self.example_id = utils.TensorBackedStringArray([t['example_id'] for t in grouped_segments], encoding = string_array_encoding)
-		if self.mode == AudioTextDataset.BATCHED_CHANNELS_MODE:
-			self.speaker = torch.tensor([speaker for t in grouped_segments for speaker in t['speaker']], dtype = torch.int64)
+		cat = lambda key, dtype: torch.from_numpy(np.concatenate([np.frombuffer(c[key], dtype = dtype) for c in columns])) if columns else torch.empty(0, dtype = getattr(torch, dtype))
+		strings = lambda key: utils.TensorBackedStringArray.from_tensors(
+			torch.from_numpy(np.frombuffer(b''.join(c[key] for c in columns), dtype = np.uint8).copy()),
+			torch.cat([torch.zeros(1, dtype = torch.int64), cat(key + '_len', 'int64').cumsum(dim = 0)])
+		)
+		self.audio_path, self.ref = strings('audio_path'), strings('ref')
+		self.begin, self.end = cat('begin', 'float64'), cat('end', 'float64')
+		self.channel = cat('channel', 'int8')
+		self.bucket = cat('bucket', 'int16')
+		self.speaker_len = torch.ones(len(self.begin), dtype = torch.int16)
+		self.transcript_cumlen = torch.arange(1, 1 + len(self.begin), dtype = torch.int64)
+
+		# speakers follow transcripts.collect_speaker_names(set_speaker_data = True), which needs flags and names of all manifests
+		speaker = cat('speaker', 'int64')
+		if speaker_names or all(c['has_speaker'] for c in columns):
+			self.speaker = speaker.clamp(min = transcripts.speaker_missing)
+		elif all(c['has_speaker_names'] for c in columns):
+			_, speaker_names_index = transcripts.index_speaker_names(name for c in columns for name in c['speaker_names'][1:])
+			self.speaker = torch.cat([torch.tensor([speaker_names_index.get(name, transcripts.speaker_missing) for name in c['speaker_names']], dtype = torch.int64)[torch.from_numpy(np.frombuffer(c['speaker_name_id'], dtype = 'int64'))] for c in columns]) if columns else speaker
 		else:
-			self.speaker = torch.tensor([t['speaker'] for t in grouped_segments], dtype = torch.int64)
-		self.speaker_len = torch.tensor(speakers_len, dtype = torch.int16)
-		self.transcript_cumlen = torch.tensor(transcripts_len, dtype = torch.int16).cumsum(dim = 0, dtype = torch.int64)
-		if pop_meta:
-			self.meta = {}
+			self.speaker = torch.where(self.channel.to(torch.int64) == transcripts.channel_missing, torch.full_like(speaker, transcripts.speaker_missing), self.channel.to(torch.int64) + 1)
+
+		if not speaker_names and all(c['has_speaker'] for c in columns):
+			self.speaker_name = utils.TensorBackedStringArray([transcripts.default_speaker_names[s] for s in self.speaker.tolist()])
+		elif speaker_names or all(c['has_speaker_names'] for c in columns):
+			self.speaker_name = strings('speaker_name')
 		else:
-			self.meta = {t['example_id']: t for t in grouped_segments}
-		_print('Dataset tensors creation time: ', time.time() - tic)
+			self.speaker_name = utils.TensorBackedStringArray([transcripts.default_channel_names[c] for c in self.channel.tolist()])
+
+		self.target, self.target_speaker, self.target_cumlen = [], [], []
+		for k in range(len(text_pipelines)):
+			target_len = cat(f'target{k}_len', 'int64')
+			self.target.append(cat(f'target{k}', 'int32'))
+			self.target_speaker.append(self.speaker.to(torch.int32).repeat_interleave(target_len))
+			self.target_cumlen.append(target_len.cumsum(dim = 0))
+		_print('Dataset columns merging time: ', time.time() - tic)
 
 	def state_dict(self) -> dict:
 		return {
@@ -183,10 +302,18 @@ class AudioTextDataset(torch.utils.data.Dataset):
 			'end'               : self.end,
 			'channel'           : self.channel,
 			'speaker'           : self.speaker,
-			'example_id'        : self.example_id,
-			'meta'              : self.meta,
+			'speaker_name'      : self.speaker_name,
 			'speaker_len'    : self.speaker_len,
-			'transcript_cumlen' : self.transcript_cumlen
+			'transcript_cumlen' : self.transcript_cumlen,
+			'target'            : self.target,
+			'target_speaker'    : self.target_speaker,
+			'target_cumlen'     : self.target_cumlen,
+			'audio_shard_paths' : self.audio_shard_paths,
+			'audio_shard_sample_rate' : self.audio_shard_sample_rate,
+			'audio_shard'       : self.audio_shard,
+			'audio_shard_offset' : self.audio_shard_offset,
+			'audio_shard_length' : self.audio_shard_length,
+			'audio_shard_num_channels' : self.audio_shard_num_channels
 		}
 
 	def load_state_dict(self, state_dict: dict):
@@ -197,15 +324,62 @@ class AudioTextDataset(torch.utils.data.Dataset):
 		self.end = state_dict['end']
 		self.channel = state_dict['channel']
 		self.speaker = state_dict['speaker']
-		self.example_id = state_dict['example_id']
-		self.meta = state_dict['meta']
+		self.speaker_name = state_dict['speaker_name']
 		self.speaker_len = state_dict['speaker_len']
 		self.transcript_cumlen = state_dict['transcript_cumlen']
+		self.target = state_dict['target']
+		self.target_speaker = state_dict['target_speaker']
+		self.target_cumlen = state_dict['target_cumlen']
+		self.audio_shard_paths = state_dict['audio_shard_paths']
+		self.audio_shard_sample_rate = state_dict['audio_shard_sample_rate']
+		self.audio_shard = state_dict['audio_shard']
+		self.audio_shard_offset = state_dict['audio_shard_offset']
+		self.audio_shard_length = state_dict['audio_shard_length']
+		self.audio_shard_num_channels = state_dict['audio_shard_num_channels']
+
+	def save_index(self, index_path):
+		# written to a temporary file first, so that a concurrently starting run never maps a partial index
+		utils.save_columnar(index_path + '.tmp', self.state_dict())
+		os.replace(index_path + '.tmp', index_path)
+
+	def load_index(self, index_path):
+		self.load_state_dict(utils.load_columnar(index_path))
 
-	def pop_meta(self):
-		meta = self.meta
-		self.meta = {}
-		return meta
+	@staticmethod
+	def index_digest(data_paths, audio_shards = None, **kwargs):
+		'''
+		Hash of manifest contents, audio shards index contents and construction arguments, naming a saved index reusable while all are unchanged
+		'''
+		digest = hashlib.md5(json.dumps(dict(kwargs, index_version = AudioTextDataset.INDEX_VERSION), sort_keys = True, default = str).encode('utf-8'))
+		# shards re-packed at the same path have new offsets, so the shards index is hashed by contents and not by path
+		for data_path in data_paths + ([audio_shards] if audio_shards is not None else []):
+			with open(data_path, 'rb') as f:
+				for chunk in iter(lambda: f.read(1 << 20), b''):
+					digest.update(chunk)
+		return digest.hexdigest()
+
+	def get_meta(self, example_ids) -> typing.List[dict]:
+		'''
+		Segment metadata gathered from the columns for a batch of integer example ids
+		'''
+		example_ids = torch.as_tensor(example_ids, dtype = torch.int64)
+		if self.mode == AudioTextDataset.BATCHED_CHANNELS_MODE:
+			speaker_len = self.speaker_len.to(torch.int64)
+			speaker_begin = (speaker_len.cumsum(dim = 0) - speaker_len)[example_ids].tolist()
+			speaker = [self.speaker[b : b + l].tolist() for b, l in zip(speaker_begin, speaker_len[example_ids].tolist())]
+		else:
+			speaker = self.speaker[example_ids].tolist()
+		columns = dict(
+			example_id = example_ids.tolist(),
+			audio_path = self.audio_path.take(example_ids),
+			ref = self.ref.take(example_ids),
+			begin = self.begin[example_ids].tolist(),
+			end = self.end[example_ids].tolist(),
+			channel = self.channel[example_ids].tolist(),
+			speaker = speaker,
+			speaker_name = self.speaker_name.take(example_ids)
+		)
+		return [dict(zip(columns, values)) for values in zip(*columns.values())]
 
 	@staticmethod
 	def get_example_id(t):
@@ -229,30 +403,63 @@ class AudioTextDataset(torch.utils.data.Dataset):
 					end = float(self.end[i]),
 					channel = int(self.channel[i]),
 					speaker = speaker,
-					example_id = self.example_id[i]
+					example_id = i
 				)
 			)
 		return transcript
 
-	def __getitem__(self, index):
-		transcript = self.unpack_transcript(index)
+	def unpack_target(self, k: int, i: int):
+		target_slice = slice(int(self.target_cumlen[k][i - 1]) if i > 0 else 0, int(self.target_cumlen[k][i]))
+		return self.target[k][target_slice].to(torch.int64), self.target_speaker[k][target_slice].to(torch.int64)
+
+	def read_features(self, transcript, i):
+		has_time_marks = all(t['begin'] != transcripts.time_missing and t['end'] != transcripts.time_missing for t in transcript)
+		# default mode items are segments of possibly the same recording: with the decoded audio cache they are sliced by time marks
+		# from the cached recording, otherwise the whole file of each item is used
+		use_audio_cache = self.mode == AudioTextDataset.DEFAULT_MODE and has_time_marks and audio.DecodedAudioCache.default() is not None
+		slice_segments = self.mode != AudioTextDataset.DEFAULT_MODE or use_audio_cache
+
+		# when segments are sliced, only the time window covering all of them is decoded
+		offset, duration = 0.0, self.max_duration
+		if slice_segments and not self.debug_short_long_records_features_from_whole_normalized_signal and has_time_marks:
+			offset = min(t['begin'] for t in transcript)
+			end = max(t['end'] for t in transcript) + 1.0 / self.sample_rate # time_slice below includes the end frame
+			end = min(end, self.max_duration) if self.max_duration is not None else end
+			duration = max(0.0, end - offset)
 
 		## signal shape here shaping.CT
 		signal: shaping.CT; sample_rate: int
-		signal, sample_rate = audio.read_audio(transcript[0]['audio_path'], sample_rate = self.sample_rate, mono = self.mono,
-		                                       backend = self.audio_backend, duration = self.max_duration,
-		                                       dtype = self.audio_dtype)
+		tic = time.time()
+		if len(self.audio_shard) > 0 and self.audio_shard[i] >= 0:
+			signal, sample_rate = audio.read_audio_shard(self.audio_shard_paths[int(self.audio_shard[i])], int(self.audio_shard_offset[i]),
+			                                             int(self.audio_shard_length[i]), int(self.audio_shard_num_channels[i]),
+			                                             self.audio_shard_sample_rate, sample_rate = self.sample_rate, mono = self.mono,
+			                                             offset = offset, duration = duration, dtype = self.audio_dtype)
+		elif use_audio_cache:
+			signal, sample_rate = audio.DecodedAudioCache.default().read_audio(transcript[0]['audio_path'], sample_rate = self.sample_rate, mono = self.mono,
+			                                                                   backend = self.audio_backend, offset = offset, duration = duration,
+			                                                                   dtype = self.audio_dtype)
+		else:
+			signal, sample_rate = audio.read_audio(transcript[0]['audio_path'], sample_rate = self.sample_rate, mono = self.mono,
+			                                       backend = self.audio_backend, offset = offset, duration = duration,
+			                                       dtype = self.audio_dtype)
 
+		with self.read_audio_stats.get_lock():
+			self.read_audio_stats[0] += time.time() - tic
+			self.read_audio_stats[1] += 1
+
+		segment_index = [i + k for k, t in enumerate(transcript) if t['channel'] < len(signal)]
 		transcript = [t for t in transcript if t['channel'] < len(signal)]
 
 		features = []
 		# slicing code in time and channel dimension
+		begin_frame = int(offset * sample_rate)
 		for t in transcript:
 			channel = t.pop('channel')
-			time_slice = slice(int(t['begin'] * sample_rate) if t['begin'] != transcripts.time_missing else 0,
-			                   1 + int(t['end'] * sample_rate) if t['end'] != transcripts.time_missing else signal.shape[1])
+			time_slice = slice(int(t['begin'] * sample_rate) - begin_frame if t['begin'] != transcripts.time_missing else 0,
+			                   1 + int(t['end'] * sample_rate) - begin_frame if t['end'] != transcripts.time_missing else signal.shape[1])
 			# signal shaping.CT -> segment shaping.1T
-			if self.mode == AudioTextDataset.DEFAULT_MODE:
+			if not slice_segments:
 				segment: shaping._T = signal[None, channel, :]  # begin, end meta could be corrupted, thats why we dont use it here
 			else:
 				segment = signal[None, channel, time_slice]
@@ -269,13 +476,37 @@ class AudioTextDataset(torch.utils.data.Dataset):
 			else:
 				features.append(segment)
 
-		# speaker alignment and ref processing code
+		return transcript, segment_index, features
+
+	def audio_byte_range(self, index):
+		# file and byte range read for an item: a region of an audio shard or a whole audio file
+		i = int(self.transcript_cumlen[index - 1]) if index % len(self) > 0 else 0
+		if len(self.audio_shard) > 0 and self.audio_shard[i] >= 0:
+			return self.audio_shard_paths[int(self.audio_shard[i])], int(self.audio_shard_offset[i]), 2 * int(self.audio_shard_length[i]) * int(self.audio_shard_num_channels[i])
+		return self.audio_path[i], 0, None
+
+	def __getitem__(self, index):
+		transcript = self.unpack_transcript(index)
+
+		i = int(self.transcript_cumlen[index - 1]) if index % len(self) > 0 else 0 # first segment of the transcript
+		example_ids = [AudioTextDataset.get_example_id(t) for t in transcript] if self.feature_cache is not None else None
+		features = self.feature_cache.get(example_ids) if self.feature_cache is not None else None
+		if features is not None:
+			segment_index = list(range(i, i + len(transcript)))
+			for t in transcript:
+				t.pop('channel')
+		else:
+			transcript, segment_index, features = self.read_features(transcript, i)
+			if self.feature_cache is not None:
+				self.feature_cache.put([example_ids[j - i] for j in segment_index], features)
+
+		# speaker aligned targets precomputed at construction
 		targets = []
 		speakers = []
-		for pipeline in self.text_pipelines:
-			encoded_refs, aligned_speakers = AudioTextDataset.encode_transcript(transcript, pipeline)
-			targets.append(encoded_refs)
-			speakers.append(aligned_speakers)
+		for k in range(len(self.target)):
+			encoded_refs, aligned_speakers = zip(*[self.unpack_target(k, j) for j in segment_index]) if segment_index else ([], [])
+			targets.append(list(encoded_refs))
+			speakers.append(list(aligned_speakers))
 
 		# replace speaker separators from ref
 		for t in transcript:
@@ -297,7 +528,6 @@ class AudioTextDataset(torch.utils.data.Dataset):
 		typing.List[dict], shaping.BS, shaping.BCT, shaping.B, shaping.BLY, shaping.B]:
 		if self.mode != AudioTextDataset.DEFAULT_MODE:
 			batch = list(zip(*batch))
-		#TODO replace meta_s to example_ids
 		meta_s, sample_s, sample_x, *sample_y = batch[0]
 		time_padding_multiple = [1, 1, self.time_padding_multiple] + [self.time_padding_multiple] * len(sample_y)
 		smax_len, xmax_len, *ymax_len = [
@@ -345,45 +575,249 @@ class AudioTextDataset(torch.utils.data.Dataset):
 			aligned_speakers.append(torch.cat(speaker_labels))
 		return encoded_refs, aligned_speakers
 
+_columns_worker_options = {}
+
+def init_columns_worker(options):
+	_columns_worker_options.update(options)
+
+
+def load_columns(data_path):
+	# default mode construction of AudioTextDataset for one manifest, kept in growing buffers of typed arrays
+	options = _columns_worker_options
+	text_pipelines = options['text_pipelines']
+	c = dict(audio_path = bytearray(), ref = bytearray(), speaker_name = bytearray(), speaker_names = [], has_speaker = True, has_speaker_names = True)
+	c.update({key: array.array('q') for key in ['audio_path_len', 'ref_len', 'speaker_name_len', 'speaker', 'speaker_name_id']})
+	c.update(begin = array.array('d'), end = array.array('d'), channel = array.array('b'), bucket = array.array('h'))
+	for k in range(len(text_pipelines)):
+		c[f'target{k}'], c[f'target{k}_len'] = array.array('i'), array.array('q')
+	speaker_name_id = {}
+
+	assert not audio.is_audio(data_path), 'Audio files not allowed as dataset input in default mode'
+	get_or_else = lambda dictionary, key, default: dictionary[key] if dictionary.get(key) is not None else default
+	exclude = set(options['exclude']) if options['exclude'] is not None else None
+	for t in transcripts.load_iter(data_path):
+		t['ref'] = get_or_else(t, 'ref', transcripts.ref_missing)
+		t['begin'] = get_or_else(t, 'begin', transcripts.time_missing)
+		t['end'] = get_or_else(t, 'end', transcripts.time_missing)
+		t['channel'] = get_or_else(t, 'channel', transcripts.channel_missing) if not options['mono'] else transcripts.channel_missing
+		c['has_speaker'] &= t.get('speaker') is not None
+		c['has_speaker_names'] &= bool(t.get('speaker_name'))
+		# like collect_speaker_names in non-streaming mode, speaker ids are indexed over all rows, including pruned ones
+		if t.get('speaker_name'):
+			speaker_name_id.setdefault(t['speaker_name'], len(speaker_name_id))
+
+		allowed_audio_names = None if exclude is None else {transcripts.audio_name(t)} - exclude
+		if not list(transcripts.prune([t], allowed_audio_names = allowed_audio_names, duration = options['duration'], max_audio_file_size = options['max_audio_file_size'])):
+			continue
+
+		for key in ['audio_path', 'ref', 'speaker_name']:
+			encoded = (t.get(key) or '').encode('utf-8')
+			c[key] += encoded
+			c[key + '_len'].append(len(encoded))
+		c['begin'].append(t['begin'])
+		c['end'].append(t['end'])
+		c['channel'].append(t['channel'])
+		c['bucket'].append(options['bucket_fn']([t]))
+		c['speaker'].append(t['speaker'] if t.get('speaker') is not None else -1)
+		c['speaker_name_id'].append(speaker_name_id[t['speaker_name']] if t.get('speaker_name') else -1)
+		for k, pipeline in enumerate(text_pipelines):
+			tokens = pipeline.encode([pipeline.preprocess(t['ref'])])[0]
+			c[f'target{k}'].extend(tokens)
+			c[f'target{k}_len'].append(len(tokens))
+
+	# names are sorted and indexed over all manifests after merging
+	c['speaker_names'] = [transcripts.speaker_name_missing] + list(speaker_name_id)
+	c['speaker_name_id'] = array.array('q', (i + 1 for i in c['speaker_name_id']))
+	return {k: v.tobytes() if isinstance(v, array.array) else bytes(v) if isinstance(v, bytearray) else v for k, v in c.items()}
+
+
+class FeatureCache:
+	'''
+	Persistent cache of frontend features of dataset segments, stored as float16 in append-only shard files (one per
+	writing process) and indexed by segment string ids in an sqlite file. Entries live in a subdirectory named by the
+	digest of frontend parameters and buffers and of dataset reading options, so any change of those starts a new cache.
+	'''
+	def __init__(self, cache_dir, digest):
+		self.cache_dir = os.path.join(cache_dir, digest)
+		self.connection = None
+		self.pid = None
+		self.shard_file = None
+		self.shards = {}
+
+	@staticmethod
+	def digest(frontend, **kwargs):
+		config = {k : v for k, v in vars(frontend).items() if not k.startswith('_') and k != 'training' and isinstance(v, (int, float, str, bool, type(None)))}
+		digest = hashlib.md5(json.dumps(dict(config, frontend = type(frontend).__name__, **kwargs), sort_keys = True).encode('utf-8'))
+		for name, tensor in sorted(frontend.state_dict().items()):
+			digest.update(name.encode('utf-8'))
+			digest.update(tensor.cpu().numpy().tobytes())
+		return digest.hexdigest()
+
+	def connect(self):
+		# sqlite connections and open shard files must not be shared with forked processes
+		if self.connection is None or self.pid != os.getpid():
+			os.makedirs(self.cache_dir, exist_ok = True)
+			self.connection = sqlite3.connect(os.path.join(self.cache_dir, 'index.sqlite'), timeout = 60)
+			self.connection.execute('PRAGMA journal_mode = WAL')
+			self.connection.execute('PRAGMA synchronous = NORMAL')
+			self.connection.execute('CREATE TABLE IF NOT EXISTS features (example_id TEXT PRIMARY KEY, shard TEXT, offset INTEGER, num_channels INTEGER, num_frames INTEGER)')
+			self.pid = os.getpid()
+			self.shard_file = None
+			self.shards = {}
+		return self.connection
+
+	def get(self, example_ids):
+		'''
+		Returns float32 features of all segments or None if any of them is missing
+		'''
+		rows = {row[0] : row[1:] for row in self.connect().execute(f'SELECT * FROM features WHERE example_id IN ({", ".join("?" * len(example_ids))})', example_ids)}
+		if len(rows) < len(set(example_ids)):
+			return None
+
+		features = []
+		for example_id in example_ids:
+			shard, offset, num_channels, num_frames = rows[example_id]
+			end = offset + num_channels * num_frames
+			# shards grow while other processes append to them, so a mapping is refreshed when it is too short
+			if shard not in self.shards or len(self.shards[shard]) < end:
+				self.shards[shard] = np.memmap(os.path.join(self.cache_dir, shard), dtype = np.float16, mode = 'r')
+			features.append(torch.from_numpy(self.shards[shard][offset:end].astype(np.float32)).view(num_channels, num_frames))
+		return features
+
+	def put(self, example_ids, features):
+		connection = self.connect()
+		if self.shard_file is None:
+			self.shard_file = open(os.path.join(self.cache_dir, f'shard_{os.uname().nodename}_{os.getpid()}.bin'), 'ab')
+
+		rows = []
+		for example_id, segment_features in zip(example_ids, features):
+			offset = self.shard_file.seek(0, os.SEEK_END) // np.dtype(np.float16).itemsize
+			self.shard_file.write(segment_features.to(torch.float16).cpu().numpy().tobytes())
+			rows.append((example_id, os.path.basename(self.shard_file.name), offset, segment_features.shape[0], segment_features.shape[-1]))
+		# features must be in the shard before index rows referencing them are visible to other processes
+		self.shard_file.flush()
+		with connection:
+			connection.executemany('INSERT OR IGNORE INTO features VALUES (?, ?, ?, ?, ?)', rows)
+
+
 class BucketingBatchSampler(torch.utils.data.Sampler):
-	def __init__(self, dataset, batch_size = 1, world_size = 1):
+	def __init__(self, dataset, batch_size = 1, world_size = 1, max_batch_frames = None, frame_duration = 0.01, time_padding_multiple = 1):
 		super().__init__(dataset)
 		self.world_size = world_size  # this value ensure that `world_size` consecutive batches will be constructed from same bucket
 		self.dataset = dataset
 		self.batch_size = batch_size
 		self.buckets = {k: (self.dataset.bucket == k).nonzero(as_tuple = True)[0] for k in self.dataset.bucket.unique()}
+		# with max_batch_frames every bucket gets its own batch size, so that batch_size * padded length of the longest example fits the budget:
+		# batches of buckets with examples of different lengths are not packed fully, but batches are computable from (epoch, p) alone
+		if max_batch_frames is not None:
+			padded_frames = self.compute_padded_frames(frame_duration, time_padding_multiple)
+			self.bucket_batch_size = {k: max(1, int(max_batch_frames // float(padded_frames[g].max()))) for k, g in self.buckets.items()}
+		else:
+			self.bucket_batch_size = {k: batch_size for k in self.buckets}
 		self.batch_idx = 0
 		self.set_epoch(epoch = 0)
 
+	def compute_padded_frames(self, frame_duration, time_padding_multiple):
+		first_segment = torch.cat([torch.zeros_like(self.dataset.transcript_cumlen[:1]), self.dataset.transcript_cumlen[:-1]])
+		begin, end = self.dataset.begin[first_segment], self.dataset.end[self.dataset.transcript_cumlen - 1]
+		duration = end - begin
+		# examples without time marks are accounted as max_duration long, or as long as their whole audio files otherwise
+		time_missing = (begin == transcripts.time_missing) | (end == transcripts.time_missing)
+		if self.dataset.max_duration is not None:
+			duration[time_missing] = self.dataset.max_duration
+		elif time_missing.any():
+			audio_paths = self.dataset.audio_path.take(first_segment[time_missing])
+			if audio.AudioMetaCache.default() is not None:
+				audio.AudioMetaCache.default().populate(audio_paths)
+			duration[time_missing] = torch.tensor(list(map(audio.compute_duration, audio_paths)), dtype = duration.dtype)
+		frames = duration / frame_duration + 1
+		return (frames / time_padding_multiple).ceil() * time_padding_multiple
+
 	def __iter__(self):
-		return iter(self.shuffled[self.batch_idx:])
+		return self.iter_batches(start = self.batch_idx)
 
 	def __len__(self):
-		return len(self.shuffled)
+		return self.num_batches
 
 	def set_epoch(self, epoch):
-		rng = torch.Generator()
-		rng.manual_seed(epoch)
-
-		def shuffle_and_split(g, batch_size):
-			required_samples_count = math.ceil(len(g) / (batch_size * self.world_size)) * (
-						batch_size * self.world_size)
-			extension_indices = torch.randint(0, len(g), size = (required_samples_count - len(g),), generator = rng,
-			                                  device = g.device)
-			g_extended = torch.cat([g, g[extension_indices]])
-			return g_extended[torch.randperm(len(g_extended), generator = rng)].reshape(-1, batch_size)
-
-		batches = torch.cat([shuffle_and_split(g, self.batch_size) for g in self.buckets.values()])
-		assert len(batches) % self.world_size == 0
-		batch_indices = torch.arange(0, len(batches))
-		shuffled_indices = torch.randperm(int(len(batches) / self.world_size), generator = rng)
-		if self.world_size > 1:
-			group_indices = batch_indices.view(-1, self.world_size)
-			shuffled_group_indices = group_indices[shuffled_indices]
-			shuffled_batch_indices = shuffled_group_indices.flatten()
-		else:
-			shuffled_batch_indices = batch_indices[shuffled_indices]
-		self.shuffled = batches[shuffled_batch_indices]
+		# nothing is materialized here: batch p of the epoch is computed on demand from (epoch, p) by self.batch
+		self.epoch = epoch
+		self.bucket_keys = list(self.buckets)
+		bucket_num_batches = [
+			math.ceil(len(self.buckets[k]) / (self.bucket_batch_size[k] * self.world_size)) * self.world_size for k in self.bucket_keys
+		]
+		self.bucket_batch_cumlen = torch.tensor([0] + bucket_num_batches, dtype = torch.int64).cumsum(dim = 0)
+		self.num_batches = int(self.bucket_batch_cumlen[-1])
+		assert self.num_batches % self.world_size == 0
+
+	def iter_batches(self, start = 0, step = 1):
+		return map(self.batch, range(start, self.num_batches, step))
+
+	def batch(self, p, epoch = None):
+		# groups of world_size consecutive batches are shuffled together, so that all ranks get batches from the same bucket
+		epoch = self.epoch if epoch is None else epoch
+		num_groups = self.num_batches // self.world_size
+		group = int(counter_based_permutation(torch.tensor([p // self.world_size]), num_groups, seed = (epoch, -1)))
+		i = group * self.world_size + p % self.world_size
+		bucket = int(torch.searchsorted(self.bucket_batch_cumlen, torch.tensor(i), right = True)) - 1
+		g, batch_size = self.buckets[self.bucket_keys[bucket]], self.bucket_batch_size[self.bucket_keys[bucket]]
+		# positions past the bucket size extend the bucket to whole groups with pseudo-random repeated examples
+		position = torch.arange(batch_size, dtype = torch.int64) + (i - int(self.bucket_batch_cumlen[bucket])) * batch_size
+		shuffled = counter_based_permutation(position.clamp(max = len(g) - 1), len(g), seed = (epoch, bucket))
+		repeated = (position * 2654435761 + epoch) % len(g)
+		return g[torch.where(position < len(g), shuffled, repeated)]
+
+	def state_dict(self):
+		return dict(batch_idx = self.batch_idx)
+
+	def load_state_dict(self, state_dict):
+		self.batch_idx = state_dict['batch_idx']
+
+
+class MixingBatchSampler(torch.utils.data.Sampler):
+	'''
+	Draws groups of world_size consecutive batches from per-corpus BucketingBatchSampler's with probabilities proportional
+	to weights. Corpora of all groups are drawn once per epoch from a generator seeded by the epoch, so that any batch is
+	computable from (epoch, p) for resuming and rank striding. A corpus exhausted before the epoch end is repeated with a
+	different shuffle. Indices are global indices of ConcatAudioTextDataset over the corpora datasets.
+	'''
+	def __init__(self, samplers, weights, world_size = 1):
+		super().__init__(None)
+		assert len(samplers) == len(weights) and all(len(sampler) > 0 for sampler in samplers)
+		self.samplers = samplers
+		self.weights = torch.tensor(weights, dtype = torch.float64)
+		self.world_size = world_size
+		self.offsets = [0] + list(itertools.accumulate(len(sampler.dataset) for sampler in samplers))[:-1]
+		self.batch_idx = 0
+		self.set_epoch(epoch = 0)
+
+	def __iter__(self):
+		return self.iter_batches(start = self.batch_idx)
+
+	def __len__(self):
+		return self.num_batches
+
+	def set_epoch(self, epoch):
+		# epoch is as long as all corpora together, so the number of batches does not depend on weights
+		self.epoch = epoch
+		num_groups = sum(map(len, self.samplers)) // self.world_size
+		self.group_corpus = torch.multinomial(self.weights, num_groups, replacement = True, generator = torch.Generator().manual_seed(epoch))
+		# group g is the k-th group of its corpus, where k is the number of earlier groups of the same corpus
+		corpus_group_count = F.one_hot(self.group_corpus, len(self.samplers)).cumsum(dim = 0)
+		self.group_corpus_group = corpus_group_count.gather(1, self.group_corpus.unsqueeze(1)).squeeze(1) - 1
+		self.num_batches = num_groups * self.world_size
+		for sampler in self.samplers:
+			sampler.set_epoch(epoch)
+
+	def iter_batches(self, start = 0, step = 1):
+		return map(self.batch, range(start, self.num_batches, step))
+
+	def batch(self, p):
+		group, r = divmod(p, self.world_size)
+		corpus = int(self.group_corpus[group])
+		sampler = self.samplers[corpus]
+		repeat, q = divmod(int(self.group_corpus_group[group]) * self.world_size + r, len(sampler))
+		return self.offsets[corpus] + sampler.batch(q, epoch = self.epoch if repeat == 0 else hash((self.epoch, repeat)) & 0x7FFFFFFF)
 
 	def state_dict(self):
 		return dict(batch_idx = self.batch_idx)
@@ -392,6 +826,50 @@ class BucketingBatchSampler(torch.utils.data.Sampler):
 		self.batch_idx = state_dict['batch_idx']
 
 
+class ConcatAudioTextDataset(torch.utils.data.ConcatDataset):
+	'''
+	AudioTextDataset's of separate corpora, each with its own index, behind global indices
+	'''
+	def __init__(self, datasets):
+		super().__init__(datasets)
+		self.mode = self.datasets[0].mode
+		self.time_padding_multiple = self.datasets[0].time_padding_multiple
+		self.collate_fn = self.datasets[0].collate_fn
+
+	def locate(self, index):
+		k = bisect.bisect_right(self.cumulative_sizes, index)
+		return k, index - (self.cumulative_sizes[k - 1] if k > 0 else 0)
+
+	def audio_byte_range(self, index):
+		k, index = self.locate(int(index))
+		return self.datasets[k].audio_byte_range(index)
+
+	@property
+	def read_audio_stats(self):
+		return [sum(dataset.read_audio_stats[j] for dataset in self.datasets) for j in range(2)]
+
+
+def counter_based_permutation(x, n, seed, rounds = 4):
+	'''
+	Element-wise bijection of int64 positions x on range(n), seeded by a tuple of ints: a Feistel network over
+	the next power of four with cycle walking, so that any element of a random permutation costs O(1) to compute
+	'''
+	half_bits = max(1, math.ceil(math.log2(max(n, 2)) / 2))
+	mask = (1 << half_bits) - 1
+	keys = [hash(seed + (r, )) & 0xFFFFFFFF for r in range(rounds)]
+	x = x.clone()
+	walking = torch.ones_like(x, dtype = torch.bool)
+	while bool(walking.any()):
+		left, right = x[walking] >> half_bits, x[walking] & mask
+		for key in keys:
+			h = (right * 0x9E3779B1 + key) & 0xFFFFFFFF
+			h = ((h ^ (h >> 15)) * 0x85EBCA6B) & 0xFFFFFFFF
+			left, right = right, left ^ ((h ^ (h >> 13)) & mask)
+		x[walking] = (left << half_bits) | right
+		walking = x >= n
+	return x
+
+
 # https://github.com/catalyst-team/catalyst/blob/master/catalyst/data/sampler.py
 class DatasetFromSampler(torch.utils.data.Dataset):
 	"""Dataset of indexes from `Sampler`."""
@@ -457,13 +935,11 @@ class DistributedSamplerWrapper(torch.utils.data.DistributedSampler):
 		self.sampler = sampler
 
 	def __iter__(self):
-		# comments are specific for BucketingBatchSampler as self.sampler, variable names are kept from Catalyst
-		self.dataset = DatasetFromSampler(self.sampler)  # hack for DistributedSampler compatibility
-		indexes_of_indexes = super().__iter__()  # type: List[int] # batch indices of BucketingBatchSampler
-		subsampler_indexes = self.dataset  # type: List[List[int]] # original example indices
-		ddp_sampling_operator = operator.itemgetter(
-			*indexes_of_indexes)  # operator to extract rank specific batches from original sampled
-		return iter(ddp_sampling_operator(subsampler_indexes))  # type: Iterable[List[int]]
+		# batches are computed lazily by BucketingBatchSampler or MixingBatchSampler, rank specific batches are every num_replicas-th from batch_idx
+		return self.sampler.iter_batches(start = self.sampler.batch_idx + self.rank, step = self.num_replicas)
+
+	def __len__(self):
+		return len(self.sampler) // self.num_replicas
 
 	def state_dict(self):
 		return self.sampler.state_dict()
@@ -484,6 +960,166 @@ class DistributedSamplerWrapper(torch.utils.data.DistributedSampler):
 		self.sampler.batch_idx = value
 
 
+class PinnedCollate:
+	'''
+	Collates lists of samples (DataLoader with collate_fn = list) in the main process into contiguous views of a ring of
+	reusable flat buffers, pinned when pin_memory is set, so that DataLoader pin_memory copies and per batch allocations are
+	avoided. Buffers grow to the largest batch seen. A ring slot is overwritten `ring_size` batches later, so ring_size must
+	exceed the number of batches alive at once (e.g. BatchedFrontend prefetch + 2).
+	'''
+	def __init__(self, data_loader, dataset, ring_size = 4, pin_memory = True):
+		self.data_loader = data_loader
+		self.dataset = dataset
+		self.pin_memory = pin_memory
+		self.ring = [{} for k in range(ring_size)]
+		self.ring_idx = 0
+
+	def __len__(self):
+		return len(self.data_loader)
+
+	def __iter__(self):
+		return map(self.collate, self.data_loader)
+
+	def buffer(self, slot, key, shape, dtype):
+		numel = int(np.prod(shape))
+		if key not in slot or slot[key].numel() < numel or slot[key].dtype != dtype:
+			slot[key] = torch.empty(numel, dtype = dtype).pin_memory() if self.pin_memory else torch.empty(numel, dtype = dtype)
+		return slot[key][:numel].view(*shape)
+
+	def collate(self, batch) -> typing.Tuple[
+		typing.List[dict], shaping.BS, shaping.BCT, shaping.B, shaping.BLY, shaping.B]:
+		if self.dataset.mode != AudioTextDataset.DEFAULT_MODE:
+			batch = list(zip(*batch))
+		slot = self.ring[self.ring_idx]
+		self.ring_idx = (self.ring_idx + 1) % len(self.ring)
+
+		meta: typing.List[dict] = [b[0] for b in batch]
+		sample_x, num_targets = batch[0][2], len(batch[0]) - 3
+		# lengths of speakers, signals / features and all targets, padded like in AudioTextDataset.collate_fn
+		lengths = torch.tensor([[t.shape[-1] for t in b[1:]] for b in batch], dtype = torch.int64)
+		multiple = torch.tensor([1] + [self.dataset.time_padding_multiple] * (1 + num_targets), dtype = torch.int64)
+		smax_len, xmax_len, *ymax_len = (((lengths.max(dim = 0).values + multiple - 1) // multiple) * multiple).tolist()
+		ymax_len = max(ymax_len, default = 0)
+
+		x: shaping.BCT = self.buffer(slot, 'x', (len(batch), len(sample_x), xmax_len), sample_x.dtype)
+		for k, b in enumerate(batch):
+			x[k, :, :b[2].shape[-1]].copy_(b[2])
+			x[k, :, b[2].shape[-1]:].zero_()
+
+		s: shaping.BS = self.buffer(slot, 's', (len(batch), smax_len), torch.int64).fill_(transcripts.speaker_missing)
+		s.masked_scatter_(torch.arange(smax_len) < lengths[:, :1], torch.cat([b[1].reshape(-1) for b in batch]))
+
+		y: shaping.BLY = self.buffer(slot, 'y', (len(batch), num_targets, ymax_len), torch.int64).zero_()
+		ylen: shaping.B = self.buffer(slot, 'ylen', (len(batch), num_targets), torch.int64).copy_(lengths[:, 2:])
+		if num_targets > 0:
+			y.masked_scatter_(torch.arange(ymax_len) < ylen.unsqueeze(-1), torch.cat([t.reshape(-1) for b in batch for t in b[3:]]).to(torch.int64))
+
+		xlen: shaping.B = self.buffer(slot, 'xlen', (len(batch), ), torch.float32)
+		xlen.copy_(lengths[:, 1].to(torch.float32) / xmax_len) if xmax_len > 0 else xlen.fill_(1.0)
+		return (meta, s, x, xlen, y, ylen)
+
+
+class AudioReadahead:
+	'''
+	Batch sampler wrapper that reads audio of the next `num_batches` batches in a thread pool, while DataLoader workers
+	process current ones, so that their reads in __getitem__ hit the OS page cache instead of slow (network) storage
+	'''
+	def __init__(self, batch_sampler, dataset, num_batches = 8, num_threads = 4, chunk_size = 1 << 20):
+		self.batch_sampler = batch_sampler
+		self.dataset = dataset
+		self.num_batches = num_batches
+		self.num_threads = num_threads
+		self.chunk_size = chunk_size
+
+	def __len__(self):
+		return len(self.batch_sampler)
+
+	def __iter__(self):
+		stop = threading.Event()
+		pool = concurrent.futures.ThreadPoolExecutor(self.num_threads)
+		try:
+			upcoming = collections.deque()
+			for batch in self.batch_sampler:
+				upcoming.append(batch)
+				for byte_range in set(map(self.dataset.audio_byte_range, batch)):
+					pool.submit(self.read, *byte_range, stop)
+				if len(upcoming) > self.num_batches:
+					yield upcoming.popleft()
+			yield from upcoming
+		finally:
+			stop.set()
+			pool.shutdown(wait = False)
+
+	def read(self, path, offset, num_bytes, stop):
+		# contents are discarded, reading is only needed to bring the pages to the page cache
+		with open(path, 'rb', buffering = 0) as f:
+			f.seek(offset)
+			while not stop.is_set() and (num_bytes is None or num_bytes > 0):
+				chunk = f.read(self.chunk_size if num_bytes is None else min(num_bytes, self.chunk_size))
+				if not chunk:
+					break
+				num_bytes = num_bytes - len(chunk) if num_bytes is not None else None
+
+
+class BatchedFrontend:
+	'''
+	Applies frontend once per padded batch of int16 signals collated from AudioTextDataset(frontend = None, audio_dtype = 'int16'),
+	either in the iterating thread or in a background thread keeping up to `prefetch` batches ready.
+	'''
+	def __init__(self, data_loader, frontend, background = False, prefetch = 2):
+		self.data_loader = data_loader
+		self.frontend = frontend
+		self.background = background
+		self.prefetch = prefetch
+
+	def __len__(self):
+		return len(self.data_loader)
+
+	def __iter__(self):
+		return self.iter_background() if self.background else map(self.apply, self.data_loader)
+
+	@torch.no_grad()
+	def apply(self, batch):
+		meta, s, x, xlen, y, ylen = batch
+		signal: shaping.BT = x.squeeze(1).to(torch.float32) / audio.smax if x.dtype == torch.int16 else x.squeeze(1)
+		mask = torch.arange(signal.shape[-1]).unsqueeze(0) < (xlen * signal.shape[-1]).ceil().unsqueeze(1)
+		return (meta, s, self.frontend(signal, mask = mask), xlen, y, ylen)
+
+	def iter_background(self):
+		batches, stop = queue.Queue(maxsize = self.prefetch), threading.Event()
+
+		def put(item):
+			while not stop.is_set():
+				try:
+					batches.put(item, timeout = 1)
+					break
+				except queue.Full:
+					pass
+
+		def run():
+			try:
+				for batch in self.data_loader:
+					if stop.is_set():
+						return
+					put(self.apply(batch))
+				put(None)
+			except Exception as e:
+				put(e)
+
+		thread = threading.Thread(target = run, daemon = True)
+		thread.start()
+		try:
+			while True:
+				batch = batches.get()
+				if batch is None:
+					break
+				if isinstance(batch, Exception):
+					raise batch
+				yield batch
+		finally:
+			stop.set()
+
+
 class Labels:
 	repeat = '2'
 	space = ' '
@@ -655,3 +1291,75 @@ class Labels:
 class Language:
 	def __new__(cls, lang):
 		return importlib.import_module(lang)
+
+
+if __name__ == '__main__':
+	import argparse
+	import models
+
+	parser = argparse.ArgumentParser()
+	subparsers = parser.add_subparsers()
+
+	def frontend(batch_size, max_duration, sample_rate, num_input_features, window_size, window_stride, time_padding_multiple, number, num_threads):
+		utils.reset_cpu_threads(num_threads)
+		frontend = models.LogFilterBankFrontend(num_input_features, sample_rate, window_size, window_stride, 'hann_window')
+		dataset = AudioTextDataset([], [], sample_rate, time_padding_multiple = time_padding_multiple)
+		signals = [audio.f2s_numpy(torch.rand(1, int(torch.randint(sample_rate, int(max_duration * sample_rate), ()))).mul_(2).sub_(1).numpy()) for k in range(batch_size)]
+		item = lambda x: [{}, torch.zeros(1, dtype = torch.int64), x, torch.zeros(1, dtype = torch.int64)]
+
+		def per_sample():
+			return dataset.collate_fn([item(frontend(torch.from_numpy(audio.s2f_numpy(signal))).squeeze(0)) for signal in signals])
+
+		def batched():
+			return BatchedFrontend(None, frontend).apply(dataset.collate_fn([item(torch.from_numpy(signal)) for signal in signals]))
+
+		for name, func in [('per_sample', per_sample), ('batched', batched)]:
+			func()
+			tic = time.perf_counter()
+			for k in range(number):
+				func()
+			print(f'| {name: >10} | {batch_size} | {number * batch_size / (time.perf_counter() - tic):.02f} samples/sec |')
+
+	def collate(batch_size, max_duration, num_input_features, window_stride, time_padding_multiple, target_length, number, ring_size):
+		dataset = AudioTextDataset([], [], 8_000, time_padding_multiple = time_padding_multiple)
+		pin_memory = torch.cuda.is_available()
+		batch = [[{}, torch.zeros(1, dtype = torch.int64),
+		          torch.rand(num_input_features, int(torch.randint(1, int(max_duration / window_stride), ()))),
+		          torch.randint(1, 100, (int(torch.randint(1, target_length, ())), ), dtype = torch.int64)] for k in range(batch_size)]
+		pinned_collate = PinnedCollate(None, dataset, ring_size = ring_size, pin_memory = pin_memory)
+		# pinning is accounted for collate_fn, as DataLoader(pin_memory = True) copies its result once more
+		collate_fn = lambda batch: [t.pin_memory() if pin_memory and isinstance(t, torch.Tensor) else t for t in dataset.collate_fn(batch)]
+
+		for name, func in [('collate_fn', collate_fn), ('pinned', pinned_collate.collate)]:
+			func(batch)
+			tic = time.perf_counter()
+			for k in range(number):
+				func(batch)
+			print(f'| {name: >10} | {batch_size} | pin_memory {pin_memory} | {(time.perf_counter() - tic) * 1000 / number:.02f} msec/batch |')
+
+	cmd = subparsers.add_parser('collate', help = 'compare collate_fn followed by pinning with PinnedCollate')
+	cmd.add_argument('--batch-size', type = int, default = 256)
+	cmd.add_argument('--max-duration', type = float, default = 10.0)
+	cmd.add_argument('--num-input-features', type = int, default = 64)
+	cmd.add_argument('--window-stride', type = float, default = 0.01)
+	cmd.add_argument('--time-padding-multiple', type = int, default = 128)
+	cmd.add_argument('--target-length', type = int, default = 200)
+	cmd.add_argument('--number', type = int, default = 20)
+	cmd.add_argument('--ring-size', type = int, default = 4)
+	cmd.set_defaults(func = collate)
+
+	cmd = subparsers.add_parser('frontend', help = 'compare samples/sec of per-sample frontend in workers and batched frontend after collate on CPU')
+	cmd.add_argument('--batch-size', type = int, default = 64)
+	cmd.add_argument('--max-duration', type = float, default = 10.0)
+	cmd.add_argument('--sample-rate', type = int, default = 8_000)
+	cmd.add_argument('--num-input-features', type = int, default = 64)
+	cmd.add_argument('--window-size', type = float, default = 0.02)
+	cmd.add_argument('--window-stride', type = float, default = 0.01)
+	cmd.add_argument('--time-padding-multiple', type = int, default = 128)
+	cmd.add_argument('--number', type = int, default = 10)
+	cmd.add_argument('--num-threads', type = int, default = 1)
+	cmd.set_defaults(func = frontend)
+
+	args = vars(parser.parse_args())
+	func = args.pop('func')
+	func(**args)
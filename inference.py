@@ -0,0 +1,150 @@
+import time
+import json
+import itertools
+import torch
+
+
+def load(scripted_model_path, device = 'cpu'):
+	'''
+	Loads a model exported by `python inference.py export`, needs only torch: returns the scripted module
+	(signal shaped BT, lengths fraction shaped B) -> (log_probs, logits, olen) and its meta (frontend and text config)
+	'''
+	extra_files = {'meta.json': ''}
+	model = torch.jit.load(scripted_model_path, map_location = device, _extra_files = extra_files)
+	return model.eval(), json.loads(extra_files['meta.json'])
+
+
+def export(checkpoint, output_path, model = None, text_config = None, device = 'cpu', sample_batch_size = 4, sample_time = 4.0, normalize_signal = False, atol = 1e-3):
+	# training code is needed only to build the module that gets traced
+	import models
+	import text_processing
+
+	torch.set_grad_enabled(False)
+	checkpoint = torch.load(checkpoint, map_location = 'cpu')
+	checkpoint_args = checkpoint['args']
+	text_config = json.load(open(text_config or checkpoint_args['text_config']))
+	text_pipeline_name = checkpoint_args.get('text_pipelines', ['char_legacy'])[0]
+	text_pipeline = text_processing.ProcessingPipeline.make(text_config, text_pipeline_name)
+
+	frontend_args = {k: checkpoint_args[k] for k in ['num_input_features', 'sample_rate', 'window_size', 'window_stride', 'window']}
+	frontend = models.LogFilterBankFrontend(
+		frontend_args['num_input_features'],
+		frontend_args['sample_rate'],
+		frontend_args['window_size'],
+		frontend_args['window_stride'],
+		frontend_args['window'],
+		normalize_signal = normalize_signal
+	)
+	model = getattr(models, model or checkpoint_args['model'])(
+		frontend_args['num_input_features'], [text_pipeline.tokenizer.vocab_size],
+		frontend = frontend,
+		dict = lambda logits,
+		log_probs,
+		olen,
+		**kwargs: (log_probs[0], logits[0], olen[0])
+	)
+	# frontend buffers (window, mel and stft bases) are rebuilt from checkpoint args above, all other weights must match exactly,
+	# so that a wrong model class or a truncated checkpoint fails here instead of producing an artifact
+	state_dict = {k: v for k, v in checkpoint['model_state_dict'].items() if not k.startswith('frontend.')}
+	state_dict.update({'frontend.' + k: v for k, v in frontend.state_dict().items()})
+	model.load_state_dict(state_dict, strict = True)
+	model.to(device)
+	model.eval()
+	model.fuse_conv_bn_eval()
+
+	x = torch.rand(sample_batch_size, int(sample_time * frontend_args['sample_rate']), device = device)
+	xlen = torch.linspace(0.5, 1.0, sample_batch_size, device = device)
+	scripted_model = torch.jit.trace(model, (x, xlen), check_trace = False)
+	if hasattr(torch.jit, 'freeze'):
+		# inlines weights as constants, so that they are folded into neighbouring ops
+		scripted_model = torch.jit.freeze(scripted_model)
+
+	# the trace must generalize to other durations
+	x = torch.rand(sample_batch_size, int(1.5 * sample_time * frontend_args['sample_rate']), device = device)
+	for expected, actual in zip(model(x, xlen), scripted_model(x, xlen)):
+		assert torch.allclose(expected.float(), actual.float(), atol = atol), f'Scripted model output differs by {float((expected.float() - actual.float()).abs().max())}'
+
+	meta = dict(frontend_args, model = model.__class__.__name__, text_config = text_config, text_pipeline = text_pipeline_name, normalize_signal = normalize_signal)
+	torch.jit.save(scripted_model, output_path, _extra_files = {'meta.json': json.dumps(meta)})
+	return output_path
+
+
+def calibration_data_loader(data_paths, text_pipeline, sample_rate, frontend = None, batch_size = 8, **kwargs):
+	import datasets
+	dataset = datasets.AudioTextDataset(data_paths, [text_pipeline], sample_rate, frontend = frontend, **kwargs)
+	return torch.utils.data.DataLoader(dataset, batch_size = batch_size, collate_fn = dataset.collate_fn)
+
+
+def quantize(model, data_loader, num_batches = 16, backend = 'fbgemm'):
+	'''
+	Post-training static int8 quantization of the conv stacks of a CPU model with fused conv-bn, in place:
+	activation ranges are calibrated on first num_batches of data_loader yielding AudioTextDataset.collate_fn batches
+	'''
+	import models
+
+	def calibrate(model):
+		num_calibration_batches = 0
+		for meta, s, x, xlen, y, ylen in itertools.islice(data_loader, num_batches):
+			model(x, xlen)
+			num_calibration_batches += 1
+		# without calibration batches observers keep default ranges and int8 outputs are garbage
+		assert num_calibration_batches > 0, 'no calibration batches, check calibration data paths'
+
+	return models.quantize_conv_static_(model, calibrate, backend = backend)
+
+
+def compare_quantized(model, quantized_model, data_loader, text_pipeline, num_batches = None):
+	'''
+	Greedy decodes the same batches with both models (called as model(x, xlen) returning either logits shaped BCt or
+	the (log_probs, logits, olen) tuple of transcribe.setup models) and returns mean CER computed by metrics.ErrorAnalyzer
+	and total forward time of each
+	'''
+	import models
+	import metrics
+	import transcripts
+	import transcript_generators
+
+	generator = transcript_generators.GreedyCTCGenerator()
+	error_analyzer = metrics.ErrorAnalyzer()
+	analyzed, time_sec = dict(fp32 = [], int8 = []), dict(fp32 = 0.0, int8 = 0.0)
+	with torch.no_grad():
+		for meta, s, x, xlen, y, ylen in itertools.islice(data_loader, num_batches):
+			for name, m in [('fp32', model), ('int8', quantized_model)]:
+				tic = time.time()
+				output = m(x, xlen)
+				time_sec[name] += time.time() - tic
+				log_probs, olen = (output[0], output[2]) if isinstance(output, tuple) else (output, models.compute_output_lengths(output, xlen))
+				generated_transcripts = generator.generate(
+					tokenizer = text_pipeline.tokenizer,
+					log_probs = log_probs,
+					begin = torch.zeros(len(log_probs)),
+					end = torch.zeros(len(log_probs)),
+					output_lengths = olen,
+					segment_text_key = 'hyp'
+				)
+				hyp = [transcripts.join(hyp = alternatives[0]) for alternatives in generated_transcripts]
+				analyzed[name].extend(error_analyzer.analyze(hyp = h, ref = text_pipeline.preprocess(t['ref']), postprocess_fn = text_pipeline.postprocess) for h, t in zip(hyp, meta))
+
+	return {name: dict(cer = error_analyzer.aggregate(analyzed[name])['cer'], time_sec = time_sec[name]) for name in analyzed}
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser()
+	subparsers = parser.add_subparsers()
+
+	cmd = subparsers.add_parser('export', help = 'trace frontend and model of a training checkpoint with fused conv-bn into a self-contained TorchScript file')
+	cmd.add_argument('--checkpoint', required = True)
+	cmd.add_argument('--output-path', '-o', required = True)
+	cmd.add_argument('--model')
+	cmd.add_argument('--text-config', help = 'overrides text config path saved in checkpoint args')
+	cmd.add_argument('--device', default = 'cpu', choices = ['cpu', 'cuda'])
+	cmd.add_argument('--sample-batch-size', type = int, default = 4)
+	cmd.add_argument('--sample-time', type = float, default = 4.0)
+	cmd.add_argument('--normalize-signal', action = 'store_true', help = 'same as in transcribe.py')
+	cmd.set_defaults(func = export)
+
+	args = vars(parser.parse_args())
+	func = args.pop('func')
+	print(func(**args))
@@ -6,6 +6,7 @@ import torch
 import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import apex
 import librosa
 import shaping
@@ -125,9 +126,35 @@ class ConvBn1d(nn.Module):
 		)
 		self.activation = ResidualActivation(nonlinearity, dropout, invertible = inplace)
 		self.temporal_mask = temporal_mask
+		self.checkpoint_repeats = 0
+
+	def forward(self, x, lengths_fraction = None, residual: typing.List = [], temporal_masks: typing.Optional[typing.Dict] = None):
+		# input not requiring grad (e.g. features into prologue) would leave checkpointed parameters without grad
+		if not self.checkpoint_repeats or not x.requires_grad:
+			return self.forward_repeats(0, len(self.conv), lengths_fraction, temporal_masks, x, *residual)
+
+		# only activations at segment boundaries are stored, repeats inside a segment are recomputed in backward
+		for begin in range(0, len(self.conv), self.checkpoint_repeats):
+			end = min(begin + self.checkpoint_repeats, len(self.conv))
+			segment_residual = residual if end == len(self.conv) else []
+			x = torch.utils.checkpoint.checkpoint(functools.partial(self.forward_repeats_recomputable, begin, end, lengths_fraction, temporal_masks), x, *segment_residual)
+		return x
 
-	def forward(self, x, lengths_fraction = None, residual: typing.List = []):
-		for i, (conv, bn) in enumerate(zip(self.conv, self.bn)):
+	def forward_repeats_recomputable(self, begin, end, lengths_fraction, temporal_masks, x, *residual):
+		# recomputation in backward runs with grad enabled and must not update batch norm running stats a second time
+		batch_norms = [bn for bn in list(self.bn[begin:end]) + list(self.bn_residual) if isinstance(bn, nn.modules.batchnorm._BatchNorm)]
+		momentum = [bn.momentum for bn in batch_norms]
+		if torch.is_grad_enabled():
+			for bn in batch_norms:
+				bn.momentum = 0.0
+		try:
+			return self.forward_repeats(begin, end, lengths_fraction, temporal_masks, x, *residual)
+		finally:
+			for bn, m in zip(batch_norms, momentum):
+				bn.momentum = m
+
+	def forward_repeats(self, begin, end, lengths_fraction, temporal_masks, x, *residual):
+		for i, (conv, bn) in enumerate(zip(self.conv[begin:end], self.bn[begin:end]), start = begin):
 			if i == len(self.conv) - 1:
 				assert len(self.conv_residual) == len(self.bn_residual) == len(residual)
 				residual_inputs = [bn(conv(r)) for conv, bn, r in zip(self.conv_residual, self.bn_residual, residual)]
@@ -136,10 +163,41 @@ class ConvBn1d(nn.Module):
 
 			x = self.activation(bn(conv(x)), residual = residual_inputs)
 			if self.temporal_mask and lengths_fraction is not None:
-				lengths = compute_output_lengths(x, lengths_fraction)
-				x = x * temporal_mask(x, lengths)
+				if temporal_masks is None:
+					lengths = compute_output_lengths(x, lengths_fraction)
+					x = x * temporal_mask(x, lengths)
+				else:
+					# masks are shared by all layers of the same time length, applied in place unless autograd saves the activation
+					mask = temporal_masks.get(x.shape[-1])
+					if mask is None:
+						mask = temporal_masks[x.shape[-1]] = temporal_mask(x, compute_output_lengths(x, lengths_fraction))
+					x = x * mask if x.requires_grad else x.mul_(mask)
 		return x
 
+	def forward_streaming(self, x, residual: typing.List = [], state: typing.Optional[typing.Dict] = None, final: bool = False):
+		# state keeps the input tails of every conv and residual frames that arrived ahead of the main path, which waits for right context
+		state = state if state is not None else dict(conv = {}, residual = [None] * len(residual))
+		for i, (conv, bn) in enumerate(zip(self.conv, self.bn)):
+			for j, module in enumerate(conv):
+				if isinstance(module, nn.Conv1d):
+					x, state['conv'][i, j] = conv1d_streaming(module, x, state['conv'].get((i, j)), final = final)
+				else:
+					x = module(x)
+
+			residual_inputs = []
+			if i == len(self.conv) - 1:
+				for k, (conv_residual, bn_residual, r) in enumerate(zip(self.conv_residual, self.bn_residual, residual)):
+					r = torch.cat([state['residual'][k], r], dim = -1) if state['residual'][k] is not None else r
+					assert r.shape[-1] >= x.shape[-1]
+					state['residual'][k] = r[..., x.shape[-1]:]
+					if x.shape[-1] > 0:
+						residual_inputs.append(bn_residual(conv_residual(r[..., :x.shape[-1]])))
+
+			# convs reject empty inputs: while the chunk has not filled the receptive field, residual frames just stay queued
+			if x.shape[-1] > 0:
+				x = self.activation(bn(x), residual = residual_inputs)
+		return x, state
+
 	def fuse_conv_bn_eval(self):
 		for i in range(len(self.conv_residual)):
 			conv, bn = self.conv_residual[i], self.bn_residual[i]
@@ -278,6 +336,7 @@ class JasperNet(nn.Module):
 		self.residual = residual
 		self.dict = dict
 		self.bpe_only = bpe_only
+		self.cache_temporal_masks = True
 
 	def forward(
 		self, x: typing.Union[shaping.BCT, shaping.BT], xlen: typing.Optional[shaping.B] = None, y: typing.Optional[shaping.BLY] = None, ylen: typing.Optional[shaping.B] = None
@@ -289,21 +348,18 @@ class JasperNet(nn.Module):
 
 		assert x.ndim == 3
 
+		# temporal masks are computed once per forward for every time length, keyed by it
+		temporal_masks = {} if self.cache_temporal_masks else None
 		if self.normalize_features is not None:
 			mask = temporal_mask(x, compute_output_lengths(x, xlen)) if xlen is not None else None
+			if temporal_masks is not None and mask is not None:
+				temporal_masks[x.shape[-1]] = mask
 			x = self.normalize_features(x, mask = mask)
 
 		residual = []
 		for i, subblock in enumerate(self.backbone):
-			x = subblock(x, residual = residual, lengths_fraction = xlen)
-			if i >= len(self.backbone) - self.num_epilogue_modules - 1:  # HACK: drop residual connections for epilogue
-				residual = []
-			elif self.residual == 'dense':
-				residual.append(x)
-			elif self.residual:
-				residual = [x]
-			else:
-				residual = []
+			x = subblock(x, residual = residual, lengths_fraction = xlen, temporal_masks = temporal_masks)
+			residual = self.next_residual(i, x, residual)
 
 		logits = self.decoder(x)
 		log_probs = [F.log_softmax(l, dim = 1).to(torch.float32) for l in logits]
@@ -318,6 +374,44 @@ class JasperNet(nn.Module):
 
 		return self.dict(logits = logits, log_probs = log_probs, olen = olen, **aux)
 
+	def forward_streaming(self, x: typing.Union[shaping.BT, shaping.BCT], state: typing.Optional[typing.Dict] = None, final: bool = False):
+		'''
+		Processes the next chunk of a stream by a non-quantized model in eval mode: signal shaped BT if the model has a frontend, features shaped BCT otherwise.
+		Returns log_probs of the frames that became complete after this chunk and the state to pass with the next chunk;
+		the last chunk (possibly empty) must be passed with final = True to flush the right context.
+		Concatenated outputs match offline forward without lengths. Per utterance normalization of signal or features
+		needs the whole utterance, so only models without it or with running stats of features are supported.
+		'''
+		assert not self.training and self.decoder.type is None
+		assert self.frontend is None or not self.frontend.normalize_signal, 'streaming requires a frontend with normalize_signal = False'
+		assert self.normalize_features is None or (self.normalize_features.track_running_stats and not self.normalize_features.legacy), 'streaming requires normalize_features = False or normalize_features_track_running_stats = True with normalize_features_legacy = False'
+		state = state if state is not None else dict(frontend = None, backbone = [None] * len(self.backbone))
+		if self.frontend is not None:
+			x, state['frontend'] = self.frontend.forward_streaming(x, state['frontend'], final = final)
+
+		if self.normalize_features is not None:
+			# running stats make normalization pointwise in time
+			x = self.normalize_features(x)
+
+		residual = []
+		for i, subblock in enumerate(self.backbone):
+			x, state['backbone'][i] = subblock.forward_streaming(x, residual = residual, state = state['backbone'][i], final = final)
+			residual = self.next_residual(i, x, residual)
+
+		logits = self.decoder(x) if x.shape[-1] > 0 else (x.new_zeros(x.shape[0], self.decoder[0].out_channels, 0), )
+		log_probs = [F.log_softmax(l, dim = 1).to(torch.float32) for l in logits]
+		return log_probs, state
+
+	def next_residual(self, i, x, residual: typing.List):
+		if i >= len(self.backbone) - self.num_epilogue_modules - 1:  # HACK: drop residual connections for epilogue
+			return []
+		elif self.residual == 'dense':
+			return residual + [x]
+		elif self.residual:
+			return [x]
+		else:
+			return []
+
 	def freeze(self, backbone = 0, decoder0 = False, frontend = False):
 		frozen_modules_list = []
 		frozen_modules_list += list(self.backbone[:backbone]) if backbone else []
@@ -335,6 +429,11 @@ class JasperNet(nn.Module):
 		for subblock in self.backbone[:K]:
 			subblock.fuse_conv_bn_eval()
 
+	def set_activation_checkpointing(self, granularity = None):
+		# granularity: None disables, 'block' checkpoints every ConvBn1d as a whole, N checkpoints every N repeats
+		for module in self.backbone:
+			module.checkpoint_repeats = len(module.conv) if granularity == 'block' else (granularity or 0)
+
 	def set_temporal_mask_mode(self, enabled):
 		for module in self.modules():
 			module.temporal_mask = enabled
@@ -555,6 +654,32 @@ class LogFilterBankFrontend(nn.Module):
 			padded_signal, (0, pad), mode = 'constant', value = 0
 		)  # TODO: avoid this second copy by doing pad manually
 
+		return self.log_mel_features(padded_signal)
+
+	def forward_streaming(self, signal: shaping.BT, state: typing.Optional[typing.Dict] = None, final: bool = False) -> typing.Tuple[shaping.BCT, typing.Dict]:
+		# state keeps the last sample for preemphasis and the padded signal tail not yet covered by a whole STFT frame
+		assert not self.normalize_signal, 'signal normalization requires the whole signal'
+		signal = signal if signal.is_floating_point() else signal.to(torch.float32)
+		if self.preemphasis > 0:
+			signal_prev = signal[..., :1] if state is None else signal[..., :1] - self.preemphasis * state['last_sample']
+			emphasized_signal = torch.cat([signal_prev, signal[..., 1:] - self.preemphasis * signal[..., :-1]], dim = -1)
+		else:
+			emphasized_signal = signal
+
+		pad = self.freq_cutoff - 1
+		if state is None:
+			assert signal.shape[-1] > pad, f'first chunk must be longer than {pad} samples for reflect padding'
+			padded_signal = torch.cat([emphasized_signal[..., 1:pad + 1].flip(-1), emphasized_signal], dim = -1)
+		else:
+			padded_signal = torch.cat([state['padded_signal'], emphasized_signal], dim = -1)
+		if final:
+			padded_signal = F.pad(padded_signal, (0, pad), mode = 'constant', value = 0)
+
+		num_frames = (padded_signal.shape[-1] - self.nfft) // self.hop_length + 1 if padded_signal.shape[-1] >= self.nfft else 0
+		log_mel_features = self.log_mel_features(padded_signal[..., :(num_frames - 1) * self.hop_length + self.nfft]) if num_frames > 0 else padded_signal.new_zeros(len(padded_signal), self.mel.out_channels, 0)
+		return log_mel_features, dict(last_sample = signal[..., -1:] if signal.shape[-1] > 0 else state['last_sample'], padded_signal = padded_signal[..., num_frames * self.hop_length:])
+
+	def log_mel_features(self, padded_signal: shaping.BT) -> shaping.BCT:
 		real_squared, imag_squared = self.stft(padded_signal.unsqueeze(dim = 1)).pow(2).split(self.freq_cutoff, dim = 1) if self.stft is not None else padded_signal.stft(self.nfft, hop_length = self.hop_length, win_length = self.win_length, window = self.window, center = False).pow(2).unbind(dim = -1)
 		power_spectrum = real_squared + imag_squared
 		log_mel_features = self.mel(power_spectrum).log()
@@ -572,6 +697,20 @@ def temporal_mask(x: shaping.BT, lengths: shaping.B):
 	return (torch.arange(x.shape[-1], device = x.device, dtype = lengths.dtype).unsqueeze(0) <
 			lengths.unsqueeze(1)).view(x.shape[:1] + (1, ) * (len(x.shape) - 2) + x.shape[-1:])
 
+def conv1d_streaming(conv: nn.Conv1d, x: shaping.BCT, cache: typing.Optional[shaping.BCT] = None, final: bool = False):
+	# same padding is emulated by zeros prepended at stream start and appended at stream end, so outputs match offline conv
+	# cache holds input frames not yet covered by a whole receptive field: at most kernel_size * dilation frames
+	(padding, ), (stride, ), (dilation, ), (kernel_size, ) = conv.padding, conv.stride, conv.dilation, conv.kernel_size
+	receptive_field = dilation * (kernel_size - 1) + 1
+	cache = cache if cache is not None else x.new_zeros(x.shape[0], x.shape[1], padding)
+	x = torch.cat([cache, x] + ([x.new_zeros(x.shape[0], x.shape[1], padding)] if final else []), dim = -1)
+	num_frames = (x.shape[-1] - receptive_field) // stride + 1 if x.shape[-1] >= receptive_field else 0
+	if num_frames == 0:
+		return x.new_zeros(x.shape[0], conv.out_channels, 0), x
+	y = F.conv1d(x[..., :(num_frames - 1) * stride + receptive_field], conv.weight, conv.bias, stride = stride, dilation = dilation, groups = conv.groups)
+	return y, x[..., num_frames * stride:]
+
+
 @torch.jit.script
 def apply_dither(x: shaping.BT, dither: float):
 	# dither extracted to ScriptFunction, because JIT does not trace randn_like correctly https://github.com/pytorch/pytorch/issues/43767
@@ -654,6 +793,27 @@ def reset_bn_running_stats_(model):
 	return model
 
 
+def quantize_conv_static_(model, calibrate, backend = 'fbgemm'):
+	# post-training static int8 quantization of ConvBn1d convs, to be called after fuse_conv_bn_eval on a CPU model
+	# every conv gets its own quant / dequant stubs, so residual sums, activations and temporal masks stay in fp32
+	# blocks left unfused (e.g. in bpe decoder) stay in fp32 entirely
+	assert hasattr(torch.nn.quantized, 'Conv1d'), 'quantized Conv1d requires PyTorch 1.6+'
+	torch.backends.quantized.engine = backend
+	qconfig = torch.quantization.get_default_qconfig(backend)
+	for module in [module for module in model.modules() if isinstance(module, ConvBn1d) and all(type(bn) == nn.Identity for bn in module.bn)]:
+		for convs in list(module.conv) + [module.conv_residual]:
+			for i in range(len(convs)):
+				if type(convs[i]) == nn.Conv1d:
+					convs[i] = torch.quantization.QuantWrapper(convs[i])
+					convs[i].qconfig = qconfig
+
+	# observers collect activation ranges during calibration forward passes
+	torch.quantization.prepare(model, inplace = True)
+	with torch.no_grad():
+		calibrate(model)
+	return torch.quantization.convert(model, inplace = True)
+
+
 def data_parallel_and_autocast(model, optimizer = None, data_parallel = True, opt_level = None, **kwargs):
 	data_parallel = data_parallel and torch.cuda.device_count() > 1
 	model_training = model.training
@@ -13,9 +13,9 @@ set -e
 #  ffmpeg -y -i $DATA_PATH/$file.wav -c:a libmp3lame -vn -ar 8000 -ac 1 -ab 128000 -f mp3 $DATA_PATH/$file.mp3
 #done
 
-echo "| file       | reads count |  backend | process_time us| perf_counter us|"
-echo "|-----------:|---:|---------:|--------------:|-------------:|"
-for backend in scipy soundfile sox ffmpeg; do
+echo "| file       | reads count |  backend | process_time us| perf_counter us| files/sec |"
+echo "|-----------:|---:|---------:|--------------:|-------------:|---------:|"
+for backend in scipy soundfile sox ffmpeg pyav; do
   for file in test_5s.wav test_1m.wav test_1h.wav \
    test_5s.mp3 test_1m.mp3 test_1h.mp3 \
    test_5s.opus test_1m.opus test_1h.opus \
@@ -23,3 +23,8 @@ for backend in scipy soundfile sox ffmpeg; do
      python audio.py timeit --audio-path $DATA_PATH/$file --mono --audio-backend $backend
   done
 done
+
+for file in test_5s.wav test_1m.wav test_1h.wav; do
+  python audio.py timeit --audio-path $DATA_PATH/$file --mono --audio-backend mmap
+  python audio.py timeit --audio-path $DATA_PATH/$file --mono --audio-backend mmap --offset 1 --duration 2
+done
@@ -16,8 +16,9 @@ import transcribe
 
 
 class SpeechServicerImpl(pb2_grpc.SpeechServicer):
-	def __init__(self, device, labels, frontend, model, decoder):
+	def __init__(self, device, labels, frontend, model, decoder, sample_rate):
 		self.device = device
+		self.sample_rate = sample_rate
 		self.labels = labels
 		self.model = model
 		self.frontend = frontend
@@ -26,9 +27,9 @@ class SpeechServicerImpl(pb2_grpc.SpeechServicer):
 	def Recognize(self, req, ctx):
 		assert req.config.encoding == pb2.RecognitionConfig.LINEAR16
 
-		signal, sample_rate = audio.read_audio(None, raw_bytes = req.audio.content, raw_sample_rate = req.config.sample_rate_hertz, raw_num_channels = req.config.audio_channel_count, dtype = 'int16', sample_rate = self.frontend.sample_rate, mono = True)
+		signal, sample_rate = audio.read_audio(None, raw_bytes = req.audio.content, raw_sample_rate = req.config.sample_rate_hertz, raw_num_channels = req.config.audio_channel_count, dtype = 'int16', sample_rate = self.sample_rate, mono = True)
 		x = signal
-		logits, olen = self.model(x.to(self.device))
+		log_probs, logits, olen = self.model(x.to(self.device, torch.float32), torch.ones(len(x), device = self.device))
 		decoded = self.decoder.decode(logits, olen)
 		ts = (x.shape[-1] / sample_rate) * torch.linspace(0, 1, steps = logits.shape[-1])
 
@@ -61,7 +62,8 @@ class SpeechServicerImpl(pb2_grpc.SpeechServicer):
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
-	parser.add_argument('--checkpoint', required = True)
+	parser.add_argument('--checkpoint')
+	parser.add_argument('--scripted-model', help = 'TorchScript file exported by `python inference.py export`, used instead of --checkpoint')
 	parser.add_argument('--model')
 	parser.add_argument('--device', default = 'cuda', choices = ['cpu', 'cuda'])
 	parser.add_argument('--decoder', choices = ['GreedyDecoder'], default = 'GreedyDecoder')
@@ -70,7 +72,7 @@ if __name__ == '__main__':
 	parser.add_argument('--num-workers', type = int, default = 10)
 	args = parser.parse_args()
 
-	service_impl = SpeechServicerImpl(args.device, *transcribe.setup(args))
+	service_impl = SpeechServicerImpl(args.device, *transcribe.setup(args), sample_rate = args.sample_rate)
 
 	server = grpc.server(concurrent.futures.ThreadPoolExecutor(max_workers = args.num_workers))
 	pb2_grpc.add_SpeechServicer_to_server(service_impl, server)
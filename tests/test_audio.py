@@ -0,0 +1,145 @@
+import math
+import shutil
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('scipy')
+pytest.importorskip('soundfile')
+
+import audio
+
+native_sample_rate = 16_000
+windows = [(0.0, 0.25), (0.3, 0.5), (0.77, None), (1.2, 1.0)]
+
+
+def skip_if_unavailable(backend):
+	# channels are probed with ffprobe and soxi
+	if backend in ['ffmpeg', 'sox'] and None in [shutil.which(backend), shutil.which(dict(ffmpeg = 'ffprobe', sox = 'soxi')[backend])]:
+		pytest.skip(f'{backend} is not installed')
+	if backend == 'pyav':
+		pytest.importorskip('av')
+
+
+@pytest.fixture
+def wav_path(tmp_path):
+	t = torch.arange(int(1.5 * native_sample_rate), dtype = torch.float64) / native_sample_rate
+	signal = torch.stack([torch.sin(2 * math.pi * 440.0 * t), torch.sin(2 * math.pi * 1234.0 * t + 1.0)])
+	signal = (0.3 * signal + 0.05 * torch.randn(signal.shape, generator = torch.Generator().manual_seed(0), dtype = torch.float64)).to(torch.float32)
+	return audio.write_audio(str(tmp_path / 'test.wav'), signal, native_sample_rate)
+
+
+@pytest.mark.parametrize('backend', ['scipy', 'mmap', 'soundfile', 'pyav', 'ffmpeg', 'sox'])
+@pytest.mark.parametrize('mono', [True, False])
+@pytest.mark.parametrize('offset,duration', windows)
+def test_windowed_read_matches_full_read_slice(wav_path, backend, mono, offset, duration):
+	skip_if_unavailable(backend)
+	full, sample_rate = audio.read_audio(wav_path, native_sample_rate, mono = mono, backend = backend)
+	window, _ = audio.read_audio(wav_path, native_sample_rate, offset = offset, duration = duration, mono = mono, backend = backend)
+	begin, end = audio.frame_range(offset, duration, sample_rate)
+	assert torch.equal(window, full[:, begin:end])
+
+
+@pytest.mark.parametrize('backend', ['scipy', 'mmap', 'soundfile', 'pyav', 'ffmpeg', 'sox'])
+@pytest.mark.parametrize('sample_rate', [8_000, 22_050])
+@pytest.mark.parametrize('offset,duration', windows)
+def test_windowed_resampled_read_matches_full_read_slice(wav_path, backend, sample_rate, offset, duration):
+	# decoders resample the whole stream before trimming, other backends resample the window with filter context around it
+	skip_if_unavailable(backend)
+	full, sample_rate = audio.read_audio(wav_path, sample_rate, backend = backend)
+	window, _ = audio.read_audio(wav_path, sample_rate, offset = offset, duration = duration, backend = backend)
+	begin, end = audio.frame_range(offset, duration, sample_rate)
+	assert window.shape == full[:, begin:end].shape
+	assert torch.allclose(window, full[:, begin:end], atol = 1e-6)
+
+
+@pytest.mark.parametrize('backend', ['scipy', 'soundfile', 'pyav', 'ffmpeg'])
+@pytest.mark.parametrize('sample_rate', [native_sample_rate, 8_000])
+@pytest.mark.parametrize('chunk_seconds,overlap_seconds', [(0.4, 0.0), (0.5, 0.1), (2.0, 0.0)])
+def test_read_audio_chunks_match_full_read_slices(wav_path, tmp_path, backend, sample_rate, chunk_seconds, overlap_seconds):
+	skip_if_unavailable(backend)
+	audio_path = wav_path
+	if backend == 'ffmpeg':
+		# ffmpeg streams non-wav files through a pipe
+		audio_path = str(tmp_path / 'test.flac')
+		audio.soundfile.write(audio_path, audio.read_audio(wav_path, native_sample_rate, mono = False)[0].t().numpy(), native_sample_rate)
+	full, _ = audio.read_audio(audio_path, sample_rate, backend = backend)
+	chunk_len, overlap_len = int(chunk_seconds * sample_rate), int(overlap_seconds * sample_rate)
+	chunks = list(audio.read_audio_chunks(audio_path, sample_rate, chunk_seconds, overlap_seconds, backend = backend))
+	assert all(signal.shape[-1] == chunk_len for offset, signal in chunks[:-1]) and 0 < chunks[-1][1].shape[-1] <= chunk_len
+	assert chunks[-1][1].shape[-1] > overlap_len or len(chunks) == 1
+	for offset, signal in chunks:
+		begin = round(offset * sample_rate)
+		assert torch.allclose(signal, full[:, begin:begin + chunk_len], atol = 1e-6)
+	assert round(chunks[-1][0] * sample_rate) + chunks[-1][1].shape[-1] == full.shape[-1]
+
+
+@pytest.mark.parametrize('backend', ['ffmpeg', 'sox'])
+@pytest.mark.parametrize('sample_rate', [native_sample_rate, 8_000])
+def test_seeking_decoder_windows_match_full_read_slice(tmp_path, backend, sample_rate):
+	# windows starting later than the seek margin make decoders seek in the input
+	skip_if_unavailable(backend)
+	signal = 0.1 * torch.randn(1, 6 * native_sample_rate, generator = torch.Generator().manual_seed(0))
+	audio_path = audio.write_audio(str(tmp_path / 'long.wav'), signal, native_sample_rate)
+	full, _ = audio.read_audio(audio_path, sample_rate, backend = backend)
+	for offset, duration in [(3.3, 1.0), (4.9, None), (2.0, 0.5)]:
+		window, _ = audio.read_audio(audio_path, sample_rate, offset = offset, duration = duration, backend = backend)
+		begin, end = audio.frame_range(offset, duration, sample_rate)
+		# rate effect of sox convolves in blocks, so its rounding may differ by a quantization step
+		assert window.shape == full[:, begin:end].shape
+		assert torch.allclose(window, full[:, begin:end], atol = 1.5 / audio.smax if backend == 'sox' and sample_rate != native_sample_rate else 0.0)
+
+
+def test_mmap_falls_back_for_unsupported_wav_formats(wav_path, tmp_path):
+	signal, _ = audio.read_audio(wav_path, native_sample_rate, mono = False, backend = 'soundfile')
+	wav_path_24bit = str(tmp_path / 'test_24bit.wav')
+	audio.soundfile.write(wav_path_24bit, signal.t().numpy(), native_sample_rate, subtype = 'PCM_24')
+	expected, _ = audio.read_audio(wav_path_24bit, native_sample_rate, mono = False, offset = 0.3, duration = 0.5, backend = 'soundfile')
+	actual, _ = audio.read_audio(wav_path_24bit, native_sample_rate, mono = False, offset = 0.3, duration = 0.5, backend = 'mmap')
+	assert actual.shape[-1] > 0 and torch.equal(actual, expected)
+
+
+def test_read_error_returns_empty_signal(tmp_path):
+	corrupted_path = tmp_path / 'corrupted.wav'
+	corrupted_path.write_bytes(b'RIFF\0\0\0\0WAVEjunk')
+	signal, _ = audio.read_audio(str(corrupted_path), native_sample_rate, backend = 'scipy')
+	assert signal.shape[-1] == 0
+
+
+@pytest.mark.parametrize('orig_sample_rate,sample_rate', [(44_100, 16_000), (8_000, 16_000)])
+def test_resample_matches_librosa(orig_sample_rate, sample_rate):
+	librosa = pytest.importorskip('librosa')
+	# band-limited test signal: tones below both Nyquist frequencies
+	t = torch.arange(int(2.0 * orig_sample_rate), dtype = torch.float64) / orig_sample_rate
+	signal = torch.stack([sum(0.1 * torch.sin(2 * math.pi * f * t + c) for f in [300.0, 1000.0, 2500.0]) for c in range(2)]).to(torch.float32)
+	resampled, _ = audio.resample(signal, orig_sample_rate, sample_rate)
+	resampled_librosa = torch.as_tensor(librosa.resample(signal.numpy(), orig_sr = orig_sample_rate, target_sr = sample_rate))
+	assert resampled.shape == resampled_librosa.shape
+	# edges are excluded, filters of different length disagree there
+	margin = sample_rate // 10
+	assert torch.allclose(resampled[..., margin:-margin], resampled_librosa[..., margin:-margin], atol = 2e-3)
+
+
+def test_audio_meta_cache_does_not_cache_failed_probes(wav_path, tmp_path):
+	cache = audio.AudioMetaCache(str(tmp_path / 'meta.sqlite'), num_workers = 1)
+	corrupted_path = tmp_path / 'corrupted.wav'
+	corrupted_path.write_bytes(b'RIFF\0\0\0\0WAVEjunk')
+	cache.populate([wav_path, str(corrupted_path)])
+	assert cache.get(wav_path) == dict(num_channels = 2, duration = 1.5)
+	assert cache.get(str(corrupted_path)) is None
+	with pytest.raises(RuntimeError):
+		cache.extract_meta(str(corrupted_path))
+
+
+@pytest.mark.parametrize('max_bytes', [2 ** 20, 1000])
+def test_decoded_audio_cache_slices_windows(wav_path, max_bytes):
+	# 1.5 sec of mono float32 audio take 96000 bytes, so the small budget makes the cache read windows directly
+	cache = audio.DecodedAudioCache(max_bytes)
+	for offset, duration in windows:
+		expected, _ = audio.read_audio(wav_path, native_sample_rate, offset = offset, duration = duration, backend = 'scipy')
+		actual, _ = cache.read_audio(wav_path, native_sample_rate, offset = offset, duration = duration, backend = 'scipy')
+		assert torch.equal(actual, expected)
+	assert cache.stats()['audio_cache_hits'] == (len(windows) - 1 if max_bytes > 96000 else 0)
+	assert len(cache.signals) == (1 if max_bytes > 96000 else 0)
+
+	cache.read_audio(wav_path, native_sample_rate, backend = 'soundfile')
+	assert cache.stats()['audio_cache_misses'] == (2 if max_bytes > 96000 else len(windows) + 1)
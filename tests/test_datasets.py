@@ -0,0 +1,49 @@
+import types
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('scipy')
+pytest.importorskip('sentencepiece')
+
+import audio
+import datasets
+import transcripts
+import utils
+
+
+def make_dataset(durations, buckets, audio_path, max_duration = None):
+	# one segment per example: the columns BucketingBatchSampler reads from AudioTextDataset
+	begin = torch.tensor([0.0 if d is not None else transcripts.time_missing for d in durations], dtype = torch.float64)
+	end = torch.tensor([d if d is not None else transcripts.time_missing for d in durations], dtype = torch.float64)
+	return types.SimpleNamespace(
+		bucket = torch.tensor(buckets, dtype = torch.short),
+		transcript_cumlen = torch.arange(1, len(durations) + 1, dtype = torch.int64),
+		begin = begin,
+		end = end,
+		audio_path = utils.TensorBackedStringArray([audio_path] * len(durations)),
+		max_duration = max_duration
+	)
+
+
+@pytest.fixture
+def wav_path(tmp_path):
+	return audio.write_audio(str(tmp_path / 'test.wav'), torch.zeros(1, 24_000), 16_000)
+
+
+def test_bucketing_batch_sampler_fits_frame_budget(wav_path):
+	durations = [1.0 + (7 * k % 23) / 2.5 for k in range(40)] + [None, None]
+	buckets = [int(d // 4) if d is not None else 0 for d in durations]
+	dataset = make_dataset(durations, buckets, wav_path)
+	max_batch_frames = 2_000
+	sampler = datasets.BucketingBatchSampler(dataset, max_batch_frames = max_batch_frames, frame_duration = 0.01, time_padding_multiple = 8)
+	padded_frames = sampler.compute_padded_frames(0.01, 8)
+
+	# examples without time marks are accounted with the probed duration of their 1.5 sec file
+	assert torch.isfinite(padded_frames).all() and float(padded_frames[-1]) == 152
+	assert {int(k): v for k, v in sampler.bucket_batch_size.items()}[0] > 1
+
+	batches = list(sampler)
+	assert len(batches) == len(sampler)
+	assert set(torch.cat(batches).tolist()) == set(range(len(durations)))
+	for batch in batches:
+		assert len(batch) * float(padded_frames[batch].max()) <= max_batch_frames
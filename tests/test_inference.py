@@ -0,0 +1,44 @@
+import os
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('apex')
+pytest.importorskip('librosa')
+pytest.importorskip('sentencepiece')
+
+import models
+import inference
+
+text_config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'configs', 'ru_text_config.json')
+checkpoint_args = dict(num_input_features = 64, sample_rate = 8_000, window_size = 0.02, window_stride = 0.01, window = 'hann_window',
+                       model = 'JasperNetSmall', text_config = text_config_path, text_pipelines = ['char_legacy'])
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+	torch.manual_seed(0)
+	frontend = models.LogFilterBankFrontend(checkpoint_args['num_input_features'], checkpoint_args['sample_rate'], checkpoint_args['window_size'], checkpoint_args['window_stride'], checkpoint_args['window'])
+	# vocab of the char_legacy tokenizer: alphabet and 5 special tokens
+	model = models.JasperNetSmall(checkpoint_args['num_input_features'], [38], frontend = frontend)
+	return dict(args = checkpoint_args, model_state_dict = model.state_dict())
+
+
+def test_export_loads_exported_model(checkpoint, tmp_path):
+	checkpoint_path, output_path = str(tmp_path / 'checkpoint.pt'), str(tmp_path / 'model.ts')
+	torch.save(checkpoint, checkpoint_path)
+	inference.export(checkpoint_path, output_path, sample_batch_size = 2, sample_time = 1.0)
+	scripted_model, meta = inference.load(output_path)
+	log_probs, logits, olen = scripted_model(torch.rand(2, 12_000), torch.tensor([1.0, 0.5]))
+	assert log_probs.shape[:2] == (2, 38) and meta['model'] == 'JasperNetSmall'
+
+
+@pytest.mark.parametrize('corruption', ['truncated', 'wrong_model'])
+def test_export_rejects_mismatched_checkpoint(checkpoint, tmp_path, corruption):
+	if corruption == 'truncated':
+		checkpoint['model_state_dict'].pop(next(k for k in checkpoint['model_state_dict'] if not k.startswith('frontend.')))
+	else:
+		checkpoint['args'] = dict(checkpoint['args'], model = 'JasperNetSmallTrainableInstanceNorm')
+	checkpoint_path = str(tmp_path / 'checkpoint.pt')
+	torch.save(checkpoint, checkpoint_path)
+	with pytest.raises(RuntimeError):
+		inference.export(checkpoint_path, str(tmp_path / 'model.ts'), sample_batch_size = 2, sample_time = 1.0)
@@ -0,0 +1,86 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('apex')
+pytest.importorskip('librosa')
+
+import models
+
+sample_rate = 8_000
+num_input_features = 16
+
+
+def make_jasper_net(frontend = True, **kwargs):
+	frontend = models.LogFilterBankFrontend(num_input_features, sample_rate, 0.02, 0.01, 'hann_window', normalize_signal = False) if frontend else None
+	model = models.JasperNet(num_input_features, [10], base_width = 8, repeat = 2, frontend = frontend, **kwargs)
+	return model.eval()
+
+
+@pytest.mark.parametrize('frontend', [True, False])
+@pytest.mark.parametrize('chunk_time', [0.25, 0.7])
+def test_streaming_matches_offline(frontend, chunk_time):
+	torch.manual_seed(0)
+	model = make_jasper_net(frontend = frontend, normalize_features = False)
+	x = torch.rand(2, 2 * sample_rate) - 0.5 if frontend else torch.randn(2, num_input_features, 200)
+	chunk_size = int(chunk_time * sample_rate) if frontend else int(chunk_time / 0.01)
+
+	with torch.no_grad():
+		offline = model(x)['log_probs'][0]
+		chunks, state = [], None
+		chunk_begins = list(range(0, x.shape[-1], chunk_size))
+		for k, begin in enumerate(chunk_begins):
+			(log_probs, ), state = model.forward_streaming(x[..., begin:begin + chunk_size], state, final = k == len(chunk_begins) - 1)
+			chunks.append(log_probs)
+		streaming = torch.cat(chunks, dim = -1)
+
+	assert streaming.shape == offline.shape
+	assert torch.allclose(streaming, offline, atol = 1e-4)
+
+
+def test_streaming_rejects_per_utterance_normalization():
+	model = make_jasper_net(normalize_features = True)
+	with pytest.raises(AssertionError):
+		model.forward_streaming(torch.rand(1, sample_rate))
+
+
+def test_cached_temporal_masks_match_recomputed():
+	torch.manual_seed(0)
+	model = make_jasper_net(frontend = False)
+	x, xlen = torch.randn(3, num_input_features, 256), torch.tensor([1.0, 0.6, 0.35])
+
+	outputs = {}
+	for cache_temporal_masks in [False, True]:
+		model.cache_temporal_masks = cache_temporal_masks
+		with torch.no_grad():
+			outputs[cache_temporal_masks] = model(x, xlen)['log_probs'][0]
+	assert torch.allclose(outputs[False], outputs[True], atol = 1e-5)
+
+	# with autograd masks are applied out of place, gradients must not change either
+	grads = {}
+	for cache_temporal_masks in [False, True]:
+		model.cache_temporal_masks = cache_temporal_masks
+		model.zero_grad()
+		model(x, xlen)['log_probs'][0].sum().backward()
+		grads[cache_temporal_masks] = [p.grad.clone() for p in model.parameters() if p.grad is not None]
+	assert all(torch.allclose(g0, g1, atol = 1e-4) for g0, g1 in zip(grads[False], grads[True]))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3])
+def test_streaming_chunks_shorter_than_receptive_field(chunk_size):
+	# first chunks complete no output frames at all, their residual frames must wait for the main path
+	torch.manual_seed(0)
+	model = make_jasper_net(frontend = False, normalize_features = False)
+	x = torch.randn(2, num_input_features, 50)
+
+	with torch.no_grad():
+		offline = model(x)['log_probs'][0]
+		chunks, state = [], None
+		chunk_begins = list(range(0, x.shape[-1], chunk_size))
+		for k, begin in enumerate(chunk_begins):
+			(log_probs, ), state = model.forward_streaming(x[..., begin:begin + chunk_size], state, final = k == len(chunk_begins) - 1)
+			chunks.append(log_probs)
+		streaming = torch.cat(chunks, dim = -1)
+
+	assert chunks[0].shape[-1] == 0
+	assert streaming.shape == offline.shape
+	assert torch.allclose(streaming, offline, atol = 1e-4)
@@ -0,0 +1,40 @@
+import os
+import json
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('sentencepiece')
+
+import text_processing
+import utils
+
+text_config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'configs', 'ru_text_config.json')
+
+
+def test_char_legacy_pipeline_round_trip():
+	text_pipeline = text_processing.ProcessingPipeline.make(json.load(open(text_config_path)), 'char_legacy')
+	text = text_pipeline.preprocess('  Привет, ММир* ааа!  ')
+	assert text == 'привет м2ир а2а'
+	tokens, = text_pipeline.encode([text])
+	assert text_pipeline.tokenizer.unk_idx not in tokens
+	decoded, = text_pipeline.decode([tokens])
+	assert decoded == text
+	assert text_pipeline.postprocess(decoded) == 'привет ммир ааа'
+
+
+def test_tensor_backed_string_array(tmp_path):
+	strings = ['привет', '', 'hello world', 'ёж', 'a' * 1000]
+	string_array = utils.TensorBackedStringArray(strings)
+	assert len(string_array) == len(strings)
+	assert [string_array[i] for i in range(len(strings))] == strings
+	assert string_array[-1] == strings[-1]
+	assert string_array[1:4] == strings[1:4]
+	assert list(string_array) == strings
+	assert string_array.take([3, 0, 3]) == [strings[3], strings[0], strings[3]]
+	with pytest.raises(IndexError):
+		string_array[len(strings)]
+
+	string_array_path = str(tmp_path / 'strings.bin')
+	string_array.save(string_array_path)
+	assert list(utils.TensorBackedStringArray.load(string_array_path)) == strings
+	assert list(utils.TensorBackedStringArray([])) == []
@@ -135,6 +135,54 @@ def cut(
 	print(output_path)
 
 
+def pack_audio(sample_rate, audio_backend, audio_path):
+	signal = audio.read_audio(audio_path, sample_rate, mono = False, backend = audio_backend)[0]
+	# shaped TC, so that frames are interleaved as in raw files
+	return audio_path, audio.f2s_numpy(signal.clamp(-1, 1).t().numpy())
+
+
+def pack(input_path, output_path, sample_rate, shard_size, audio_backend, num_workers):
+	os.makedirs(output_path, exist_ok = True)
+
+	audio_paths = sorted(set(t['audio_path'] for t in transcripts.load(input_path)))
+	print('Unique audio_path count: ', len(audio_paths))
+
+	index = dict(sample_rate = sample_rate, shard_paths = [], audio_path = [], shard = [], offset = [], length = [], num_channels = [])
+	shard_file = None
+	with multiprocessing.pool.Pool(processes = num_workers) as pool:
+		map_func = functools.partial(pack_audio, sample_rate, audio_backend)
+		for audio_path, signal in tqdm.tqdm(pool.imap(map_func, audio_paths), total = len(audio_paths)):
+			if signal.size == 0:
+				print('Empty audio_path ', audio_path)
+				continue
+
+			if shard_file is None or shard_file.tell() + signal.nbytes > shard_size * 1e6:
+				if shard_file is not None:
+					shard_file.close()
+				index['shard_paths'].append('shard_{:05d}.raw'.format(len(index['shard_paths'])))
+				shard_file = open(os.path.join(output_path, index['shard_paths'][-1]), 'wb')
+
+			index['audio_path'].append(audio_path)
+			index['shard'].append(len(index['shard_paths']) - 1)
+			index['offset'].append(shard_file.tell())
+			index['length'].append(signal.shape[0])
+			index['num_channels'].append(signal.shape[1])
+			shard_file.write(signal.astype('<i2').tobytes())
+
+	if shard_file is not None:
+		shard_file.close()
+
+	index.update(
+		shard = torch.tensor(index['shard'], dtype = torch.int16),
+		offset = torch.tensor(index['offset'], dtype = torch.int64),
+		length = torch.tensor(index['length'], dtype = torch.int64),
+		num_channels = torch.tensor(index['num_channels'], dtype = torch.int8)
+	)
+	index_path = os.path.join(output_path, 'index.pt')
+	torch.save(index, index_path)
+	print(index_path)
+
+
 def cat(input_path, output_path):
 	transcript_paths = [transcript_path for transcript_path in input_path if transcript_path.endswith('.json')] + [
 		os.path.join(transcript_dir, transcript_name) for transcript_dir in input_path if os.path.isdir(transcript_dir)
@@ -148,7 +196,8 @@ def cat(input_path, output_path):
 	print(output_path)
 
 
-def du(input_path):
+def du(input_path, audio_meta_cache = None):
+	audio.AudioMetaCache.init_default(audio_meta_cache)
 	transcript = json.load(open(input_path))
 	print(
 		input_path,
@@ -437,8 +486,10 @@ def split(
 	val_duration_in_hours,
 	microval_duration_in_hours,
 	old_microval_path,
-	seed
+	seed,
+	audio_meta_cache = None
 ):
+	audio.AudioMetaCache.init_default(audio_meta_cache)
 	transcripts_train = json.load(open(input_path))
 
 	random.seed(seed)
@@ -521,11 +572,20 @@ if __name__ == '__main__':
 	cmd.add_argument('--strip', nargs = '*', default = ['alignment', 'words'])
 	cmd.add_argument('--mono', action = 'store_true')
 	cmd.add_argument('--strip-prefix', type = str, default = '')
-	cmd.add_argument('--audio-backend', default = 'ffmpeg', choices = ['sox', 'ffmpeg'])
+	cmd.add_argument('--audio-backend', default = 'ffmpeg', choices = ['sox', 'ffmpeg', 'pyav'])
 	cmd.add_argument('--add-sub-paths', action = 'store_true')
 	cmd.add_argument('--num-workers', type = int, default = 32)
 	cmd.set_defaults(func = cut)
 
+	cmd = subparsers.add_parser('pack')
+	cmd.add_argument('--input-path', '-i', required = True)
+	cmd.add_argument('--output-path', '-o', required = True)
+	cmd.add_argument('--sample-rate', '-r', type = int, default = 8_000, choices = [8_000, 16_000, 32_000, 48_000])
+	cmd.add_argument('--shard-size', type = int, default = 4096, help = 'in megabytes')
+	cmd.add_argument('--audio-backend', default = 'ffmpeg', choices = ['sox', 'ffmpeg', 'pyav'])
+	cmd.add_argument('--num-workers', type = int, default = 32)
+	cmd.set_defaults(func = pack)
+
 	cmd = subparsers.add_parser('cat')
 	cmd.add_argument('--input-path', '-i', nargs = '+')
 	cmd.add_argument('--output-path', '-o')
@@ -560,6 +620,7 @@ if __name__ == '__main__':
 
 	cmd = subparsers.add_parser('du')
 	cmd.add_argument('input_path')
+	cmd.add_argument('--audio-meta-cache')
 	cmd.set_defaults(func = du)
 
 	cmd = subparsers.add_parser('transcode')
@@ -588,6 +649,7 @@ if __name__ == '__main__':
 	cmd.add_argument('--val-duration-in-hours', required = True, type = float)
 	cmd.add_argument('--microval-duration-in-hours', required = True, type = float)
 	cmd.add_argument('--seed', required = True, type = int, default = 42)
+	cmd.add_argument('--audio-meta-cache')
 	cmd.set_defaults(func = split)
 
 	cmd = subparsers.add_parser('processcomments')
@@ -23,6 +23,7 @@ import torch.utils.tensorboard
 import onnxruntime
 import apex
 import datasets
+import audio
 import transcript_generators
 import metrics
 import models
@@ -326,6 +327,9 @@ def evaluate_model(
 
 
 def main(args):
+	audio.AudioMetaCache.init_default(args.audio_meta_cache)
+	audio.DecodedAudioCache.init_default(args.audio_cache_size * 2 ** 20)
+
 	checkpoints = [torch.load(checkpoint_path, map_location = 'cpu') for checkpoint_path in args.checkpoint]
 	checkpoint = (checkpoints + [{}])[0]
 	if len(checkpoints) > 1:
@@ -417,6 +421,7 @@ def main(args):
 		**(dict(inplace = False, dict = lambda logits, log_probs, olen, **kwargs: logits[0]) if args.onnx else {})
 	)
 
+	model.set_activation_checkpointing(args.activation_checkpointing)
 	_print('Model capacity:', int(models.compute_capacity(model, scale = 1e6)), 'million parameters\n')
 
 	if checkpoint:
@@ -487,7 +492,7 @@ def main(args):
 												frontend = val_frontend if not args.frontend_in_model else None,
 												min_duration = args.min_duration,
 												time_padding_multiple = args.batch_time_padding_multiple,
-												pop_meta = True,
+												feature_cache = args.feature_cache,
 												_print = _print)
 		if args.world_size > 1:
 			sampler = torch.utils.data.DistributedSampler(val_dataset, num_replicas = args.world_size, rank = args.rank, shuffle = False)
@@ -526,60 +531,61 @@ def main(args):
 
 	train_frontend = frontend
 	tic = time.time()
-	if args.local_rank == 0:
-		train_dataset = datasets.AudioTextDataset(
-			args.train_data_path,
-			text_pipelines,
-			args.sample_rate,
-			frontend = train_frontend if not args.frontend_in_model else None,
-			min_duration = args.min_duration,
-			max_duration = args.max_duration,
-			time_padding_multiple = args.batch_time_padding_multiple,
-			bucket_fn = lambda example: int(
-				math.ceil(
-					((example[-1]['end'] - example[0]['begin']) / args.window_stride + 1) / args.batch_time_padding_multiple
-				)
-			),
-			pop_meta = True,
-			_print = _print
-		)
-		if args.world_size > 1:
-			cache_path = f'{args.experiment_dir}/dataset_cache.pt'
-			if os.path.exists(cache_path):
-				os.remove(cache_path)
-			torch.save(train_dataset.state_dict(), cache_path)
+	make_train_dataset = lambda data_paths, audio_shards = None: datasets.AudioTextDataset(
+		data_paths,
+		text_pipelines,
+		args.sample_rate,
+		frontend = train_frontend if not args.frontend_in_model and not args.frontend_batched else None,
+		audio_dtype = 'int16' if args.frontend_batched else 'float32',
+		min_duration = args.min_duration,
+		max_duration = args.max_duration,
+		time_padding_multiple = args.batch_time_padding_multiple,
+		bucket_fn = lambda example: int(
+			math.ceil(
+				((example[-1]['end'] - example[0]['begin']) / args.window_stride + 1) / args.batch_time_padding_multiple
+			)
+		),
+		audio_shards = audio_shards,
+		feature_cache = args.feature_cache,
+		streaming = args.train_data_streaming,
+		streaming_num_workers = args.train_data_streaming_num_workers,
+		_print = _print
+	)
+	# columnar index is reused across runs while manifests and dataset arguments are unchanged, all ranks map the same file
+	train_dataset_index = lambda data_paths: os.path.join(args.dataset_index_dir or args.experiment_dir, 'dataset_index_{digest}.bin'.format(digest = datasets.AudioTextDataset.index_digest(
+		data_paths,
+		text_config = text_config,
+		text_pipelines = args.text_pipelines,
+		audio_shards = args.train_audio_shards,
+		**{k: getattr(args, k) for k in ['sample_rate', 'min_duration', 'max_duration', 'batch_time_padding_multiple', 'window_stride']}
+	)))
+	# with mixing every corpus has an index of its own, so adding a corpus does not rebuild indices of others
+	train_corpora = [[data_path] for data_path in args.train_data_path] if args.train_data_mixing else [args.train_data_path]
+	for data_paths in train_corpora:
+		if args.local_rank == 0 and not os.path.exists(train_dataset_index(data_paths)):
+			os.makedirs(os.path.dirname(train_dataset_index(data_paths)), exist_ok = True)
+			make_train_dataset(data_paths, audio_shards = args.train_audio_shards).save_index(train_dataset_index(data_paths))
 
 	if args.world_size > 1:
-		# waiting for dataset cache serialization
+		# waiting for dataset index serialization
 		dist.barrier()
 
-	if args.local_rank != 0:
-		train_dataset = datasets.AudioTextDataset(
-			[],
-			text_pipelines,
-			args.sample_rate,
-			frontend=train_frontend if not args.frontend_in_model else None,
-			min_duration=args.min_duration,
-			max_duration=args.max_duration,
-			time_padding_multiple=args.batch_time_padding_multiple,
-			bucket_fn =lambda example: int(
-				math.ceil(
-					((example[-1]['end'] - example[0]['begin']) / args.window_stride + 1) / args.batch_time_padding_multiple
-				)
-			),
-			pop_meta=True,
-			_print=_print
-		)
-		train_dataset.load_state_dict(torch.load(f'{args.experiment_dir}/dataset_cache.pt'))
-
-	if args.world_size > 1:
-		# waiting for dataset cache loading
-		dist.barrier()
+	train_datasets = [make_train_dataset([]) for data_paths in train_corpora]
+	for train_dataset, data_paths in zip(train_datasets, train_corpora):
+		train_dataset.load_index(train_dataset_index(data_paths))
+	train_dataset = datasets.ConcatAudioTextDataset(train_datasets) if args.train_data_mixing else train_datasets[0]
 
 	_print('Time train dataset created:', time.time() - tic, 'sec')
 	train_dataset_name = '_'.join(map(os.path.basename, args.train_data_path))
 	tic = time.time()
-	sampler = datasets.BucketingBatchSampler(train_dataset, batch_size = args.train_batch_size, world_size = args.world_size)
+	samplers = [datasets.BucketingBatchSampler(dataset, batch_size = args.train_batch_size, world_size = args.world_size,
+											   max_batch_frames = args.train_batch_frames, frame_duration = args.window_stride,
+											   time_padding_multiple = args.batch_time_padding_multiple) for dataset in train_datasets]
+	if args.train_data_mixing:
+		assert len(args.train_data_mixing) == len(args.train_data_path), '--train-data-mixing must have a weight per --train-data-path'
+		sampler = datasets.MixingBatchSampler(samplers, args.train_data_mixing, world_size = args.world_size)
+	else:
+		sampler = samplers[0]
 	if args.world_size > 1:
 		sampler = datasets.DistributedSamplerWrapper(sampler, num_replicas=args.world_size, rank=args.rank)
 	_print('Time train sampler created:', time.time() - tic, 'sec')
@@ -587,12 +593,16 @@ def main(args):
 	train_data_loader = torch.utils.data.DataLoader(
 		train_dataset,
 		num_workers = args.num_workers,
-		collate_fn = train_dataset.collate_fn,
-		pin_memory = True,
-		batch_sampler = sampler,
+		collate_fn = train_dataset.collate_fn if not args.train_collate_ring_size else list,
+		pin_memory = not args.train_collate_ring_size,
+		batch_sampler = datasets.AudioReadahead(sampler, train_dataset, num_batches = args.train_readahead_batches, num_threads = args.train_readahead_threads) if args.train_readahead_batches else sampler,
 		worker_init_fn = datasets.worker_init_fn,
 		timeout = args.timeout if args.num_workers > 0 else 0
 	)
+	if args.train_collate_ring_size:
+		train_data_loader = datasets.PinnedCollate(train_data_loader, train_dataset, ring_size = args.train_collate_ring_size, pin_memory = args.device != 'cpu')
+	if args.frontend_batched and not args.frontend_in_model:
+		train_data_loader = datasets.BatchedFrontend(train_data_loader, train_frontend, background = args.frontend_batched == 'thread')
 
 	if args.optimizer == 'SGD':
 		optimizer = torch.optim.SGD(model.parameters(),
@@ -746,6 +756,10 @@ def main(args):
 			time_ms_data, time_ms_fwd, time_ms_bwd, time_ms_model = map(lambda sec: sec * 1000, [toc_data - tic, toc_fwd - toc_data, toc_bwd - toc_fwd, toc_bwd - toc_data])
 			perf.update(dict(time_ms_data = time_ms_data, time_ms_fwd = time_ms_fwd, time_ms_bwd = time_ms_bwd, time_ms_iteration = time_ms_data + time_ms_model), prefix = 'performance')
 			perf.update(dict(input_B = x.shape[0], input_T = x.shape[-1]), prefix = 'performance')
+			read_audio_sec, read_audio_count = train_dataset.read_audio_stats[:]
+			perf.update(dict(time_ms_read_audio = 1000 * read_audio_sec / max(1, read_audio_count)), prefix = 'performance')
+			if audio.DecodedAudioCache.default() is not None:
+				perf.update(audio.DecodedAudioCache.default().stats(), prefix = 'performance')
 			print_left = f'{args.experiment_id} | epoch: {epoch:02d} iter: [{batch_idx: >6d} / {len(train_data_loader)} {iteration: >6d}] {"x".join(map(str, x.shape))}'
 			print_right = 'ent: <{avg_entropy:.2f}> loss: {cur_loss_BT_normalized:.2f} <{avg_loss_BT_normalized:.2f}> time: {performance_cur_time_ms_data:.2f}+{performance_cur_time_ms_fwd:4.0f}+{performance_cur_time_ms_bwd:4.0f} <{performance_avg_time_ms_iteration:.0f}> | lr: {cur_lr:.5f}'.format(**perf.default())
 			_print(print_left, print_right)
@@ -851,10 +865,11 @@ if __name__ == '__main__':
 		help = 'limitation on how many samples will be skipped from each epoch, using some --iterations-per-epoch value'
 	)
 	parser.add_argument('--train-data-path', nargs = '*', default = [])
-	parser.add_argument('--train-data-mixing', type = float, nargs = '*')
+	parser.add_argument('--train-data-mixing', type = float, nargs = '*', help = 'per --train-data-path batch sampling weights, every corpus gets its own dataset index')
 	parser.add_argument('--val-data-path', nargs = '*', default = [])
 	parser.add_argument('--num-workers', type = int, default = 64)
 	parser.add_argument('--train-batch-size', type = int, default = 256)
+	parser.add_argument('--train-batch-frames', type = int, help = 'per process budget of padded frames in a train batch, replaces --train-batch-size for bucketing: every bucket gets a fixed batch size fitting its longest example into the budget, so batches of buckets with mixed lengths may stay below it; examples longer than the budget get batches of their own')
 	parser.add_argument('--val-batch-size', type = int, default = 256)
 	parser.add_argument('--device', default = 'cuda', choices = ['cuda', 'cpu'])
 	parser.add_argument(
@@ -888,6 +903,7 @@ if __name__ == '__main__':
 	)
 	parser.add_argument('--model', default = 'JasperNetBig')
 	parser.add_argument('--frontend', default = 'LogFilterBankFrontend')
+	parser.add_argument('--activation-checkpointing', type = lambda x: x if x == 'block' else int(x), help = 'recompute activations in backward instead of storing them: for every backbone block as a whole (block) or for every N repeats (N)')
 	parser.add_argument(
 		'--seed',
 		type = int,
@@ -952,6 +968,13 @@ if __name__ == '__main__':
 		default = 0.1,
 		help = 'in seconds; drop in DataLoader all utterances smaller than this value'
 	)
+	parser.add_argument('--train-audio-shards', help = 'index.pt produced by tools.py pack, train audio is read from its shards instead of decoding')
+	parser.add_argument('--train-data-streaming', action = 'store_true', help = 'build train dataset from JSON / JSON Lines manifests without loading them as a whole')
+	parser.add_argument('--train-data-streaming-num-workers', type = int, default = 0, help = 'processes parsing train manifests in streaming mode')
+	parser.add_argument('--dataset-index-dir', help = 'directory of columnar train dataset indices reused across runs, experiment dir by default')
+	parser.add_argument('--feature-cache', help = 'directory of float16 frontend features cached on first pass, not used with dither')
+	parser.add_argument('--audio-cache-size', type = int, default = 0, help = 'in megabytes, per worker LRU cache of decoded recordings, segments with time marks are then sliced from them in default dataset mode')
+	parser.add_argument('--audio-meta-cache', help = 'sqlite file to persist audio durations and channel counts between runs')
 	parser.add_argument('--exphtml', default = '../stt_results')
 	parser.add_argument('--freeze-backbone', type = int, default = 0, help = 'freeze number of backbone layers')
 	parser.add_argument('--freeze-decoder', action = 'store_true', help = 'freeze decoder0')
@@ -979,6 +1002,10 @@ if __name__ == '__main__':
 	parser.add_argument('--text-config', default = 'configs/ru_text_config.json')
 	parser.add_argument('--text-pipelines', nargs = '+', help = 'text processing pipelines (names should be defined in text-config)', default = ['char_legacy'])
 	parser.add_argument('--frontend-in-model', action = 'store_true')
+	parser.add_argument('--train-readahead-batches', type = int, default = 0, help = 'read audio of this many upcoming train batches into the page cache in background threads')
+	parser.add_argument('--train-readahead-threads', type = int, default = 4)
+	parser.add_argument('--train-collate-ring-size', type = int, default = 0, help = 'collate train batches in the main process into a ring of this many reusable pinned buffers')
+	parser.add_argument('--frontend-batched', choices = ['main', 'thread'], help = 'train workers return int16 signals and frontend is applied per padded batch in the main process or in a background thread')
 	parser.add_argument('--batch-time-padding-multiple', type = int, default = 128)
 	parser.add_argument('--oom-retries', type = int, default = 3)
 	parser.add_argument('--val-config', default = 'configs/ru_val_config.json')
@@ -9,19 +9,30 @@ import time
 import json
 import argparse
 import torch
-import datasets
-import models
+import audio
 import metrics
 import transcript_generators
 import ctc
 import transcripts
-import vis
 import utils
 import shaping
 import text_processing
+import inference
 
 def setup(args):
 	torch.set_grad_enabled(False)
+	if args.scripted_model:
+		assert not getattr(args, 'quantize', False), '--quantize is not supported with --scripted-model, quantize the checkpoint model instead'
+		# exported model includes the frontend, no Python model is constructed
+		model, meta = inference.load(args.scripted_model, device = args.device)
+		args.sample_rate, args.window_size, args.window_stride, args.window, args.num_input_features = map(meta.get, ['sample_rate', 'window_size', 'window_stride', 'window', 'num_input_features'])
+		args.frontend_in_model = True
+		text_pipeline = text_processing.ProcessingPipeline.make(meta['text_config'], meta['text_pipeline'])
+		return text_pipeline, None, model, transcript_generators.GreedyCTCGenerator()
+
+	# training code (and apex) is imported only to build a model from a checkpoint
+	import models
+
 	checkpoint = torch.load(args.checkpoint, map_location = 'cpu')
 	args.sample_rate, args.window_size, args.window_stride, args.window, args.num_input_features = map(checkpoint['args'].get, ['sample_rate', 'window_size', 'window_stride', 'window', 'num_input_features'])
 	frontend = models.LogFilterBankFrontend(
@@ -53,6 +64,17 @@ def setup(args):
 	model = model.to(args.device)
 	model.eval()
 	model.fuse_conv_bn_eval()
+	if args.quantize:
+		assert args.device == 'cpu', 'int8 quantized convolutions run only on CPU'
+		assert args.quantize_calibration_data_path, '--quantize requires --quantize-calibration-data-path'
+		calibration_data_loader = inference.calibration_data_loader(
+			args.quantize_calibration_data_path, text_pipeline, args.sample_rate,
+			frontend = frontend if not args.frontend_in_model else None,
+			mono = args.mono,
+			time_padding_multiple = args.batch_time_padding_multiple,
+			audio_backend = args.audio_backend
+		)
+		inference.quantize(model, calibration_data_loader, num_batches = args.quantize_calibration_batches)
 	if args.device != 'cpu':
 		model, *_ = models.data_parallel_and_autocast(model, opt_level = args.fp16)
 	generator = transcript_generators.GreedyCTCGenerator()
@@ -60,7 +82,11 @@ def setup(args):
 
 
 def main(args, ext_json = ['.json', '.json.gz']):
+	import datasets
+
 	utils.enable_jit_fusion()
+	audio.AudioMetaCache.init_default(args.audio_meta_cache)
+	audio.DecodedAudioCache.init_default(args.audio_cache_size * 2 ** 20)
 
 	assert args.output_json or args.output_html or args.output_txt or args.output_csv, \
 		'at least one of the output formats must be provided'
@@ -89,14 +115,13 @@ def main(args, ext_json = ['.json', '.json.gz']):
 		mono = args.mono,
 		time_padding_multiple = args.batch_time_padding_multiple,
 		audio_backend = args.audio_backend,
+		feature_cache = args.feature_cache,
 		exclude = exclude,
 		max_duration = args.transcribe_first_n_sec,
 		mode = 'batched_channels' if args.join_transcript else 'batched_transcript',
-		string_array_encoding = args.dataset_string_array_encoding,
 		debug_short_long_records_features_from_whole_normalized_signal = args.debug_short_long_records_features_from_whole_normalized_signal
 	)
 	print('Examples count: ', len(val_dataset))
-	val_meta = val_dataset.pop_meta()
 	val_data_loader = torch.utils.data.DataLoader(
 		val_dataset, batch_size = None, collate_fn = val_dataset.collate_fn, num_workers = args.num_workers
 	)
@@ -106,7 +131,7 @@ def main(args, ext_json = ['.json', '.json.gz']):
 	oom_handler = utils.OomHandler(max_retries = args.oom_retries)
 	for i, (meta, s, x, xlen, y, ylen) in enumerate(val_data_loader):
 		print(f'Processing: {i}/{len(val_dataset)}')
-		meta = [val_meta[t['example_id']] for t in meta]
+		meta = val_dataset.get_meta([t['example_id'] for t in meta])
 
 		audio_path = meta[0]['audio_path']
 		audio_name = transcripts.audio_name(audio_path)
@@ -259,6 +284,7 @@ def main(args, ext_json = ['.json', '.json.gz']):
 			print(transcripts.save(transcript_path, filtered_transcript))
 
 		if args.output_html:
+			import vis
 			transcript_path = os.path.join(args.output_path, audio_name + '.html')
 			print(vis.transcript(transcript_path, args.sample_rate, args.mono, transcript, filtered_transcript))
 
@@ -288,6 +314,8 @@ def main(args, ext_json = ['.json', '.json.gz']):
 			torch.save([dict(audio_path = audio_path, logits = l[..., logits_crop[i]], **begin_end[i], ref = ref, hyp = hyp ) for i, l in enumerate(logits.cpu())], logits_file_path)
 			print(logits_file_path)
 
+		if audio.DecodedAudioCache.default() is not None:
+			print('Decoded audio cache: {audio_cache_hits} hits | {audio_cache_misses} misses'.format(**audio.DecodedAudioCache.default().stats()))
 		print('Done: {:.02f} sec\n'.format(time.time() - tic))
 
 	if args.output_csv:
@@ -300,8 +328,12 @@ def main(args, ext_json = ['.json', '.json.gz']):
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--verbose', action = 'store_true')
-	parser.add_argument('--checkpoint', required = True)
+	parser.add_argument('--checkpoint')
+	parser.add_argument('--scripted-model', help = 'TorchScript file exported by `python inference.py export`, used instead of --checkpoint')
 	parser.add_argument('--model')
+	parser.add_argument('--quantize', action = 'store_true', help = 'int8 static quantization of conv stacks, CPU only, see benchmark.py --quantize for CER delta and speedup')
+	parser.add_argument('--quantize-calibration-data-path', nargs = '+', default = [], help = 'manifests for calibration of activation ranges')
+	parser.add_argument('--quantize-calibration-batches', type = int, default = 16)
 	parser.add_argument('--batch-time-padding-multiple', type = int, default = 128)
 	parser.add_argument('--ext', default = ['wav', 'mp3', 'opus', 'm4a'])
 	parser.add_argument('--skip-processed', action = 'store_true')
@@ -316,7 +348,10 @@ if __name__ == '__main__':
 	parser.add_argument('--fp16', choices = ['O0', 'O1', 'O2', 'O3'], default = None)
 	parser.add_argument('--num-workers', type = int, default = 0)
 	parser.add_argument('--mono', action = 'store_true')
-	parser.add_argument('--audio-backend', default = None, choices = ['sox', 'ffmpeg'])
+	parser.add_argument('--audio-backend', default = None, choices = ['sox', 'ffmpeg', 'mmap', 'pyav'])
+	parser.add_argument('--feature-cache', help = 'directory of float16 frontend features cached on first pass, not used with dither')
+	parser.add_argument('--audio-cache-size', type = int, default = 0, help = 'in megabytes, per worker LRU cache of decoded recordings, segments with time marks are then sliced from them in default dataset mode')
+	parser.add_argument('--audio-meta-cache', help = 'sqlite file to persist audio durations and channel counts between runs')
 	parser.add_argument('--decoder', default = 'GreedyDecoder', choices = ['GreedyDecoder', 'BeamSearchDecoder'])
 	parser.add_argument('--decoder-topk', type = int, default = 1)
 	parser.add_argument('--beam-width', type = int, default = 5000)
@@ -340,7 +375,6 @@ if __name__ == '__main__':
 	parser.add_argument('--join-transcript', action = 'store_true')
 	parser.add_argument('--pack-backpointers', action = 'store_true')
 	parser.add_argument('--oom-retries', type = int, default = 3)
-	parser.add_argument('--dataset-string-array-encoding', default = 'utf_32_le', choices = ['utf_16_le', 'utf_32_le'])
 	parser.add_argument('--normalize-signal', action = 'store_true')
 	parser.add_argument('--debug-short-long-records-normalize-signal-multiplier', action = 'store_true')
 	parser.add_argument('--debug-short-long-records-features-from-whole-normalized-signal', action = 'store_true')
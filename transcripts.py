@@ -55,6 +55,48 @@ def load(data_path):
 
 	return transcript
 
+def load_iter(data_path, chunk_size = 1 << 20):
+	# streaming load: JSON Lines are parsed line by line and JSON arrays element by element without reading the whole file
+	if data_path.endswith('.jsonl') or data_path.endswith('.jsonl.gz'):
+		with utils.open_maybe_gz(data_path) as f:
+			for line in f:
+				if line.strip():
+					yield json.loads(line)
+
+	elif data_path.endswith('.json') or data_path.endswith('.json.gz'):
+		decoder = json.JSONDecoder()
+		with utils.open_maybe_gz(data_path) as f:
+			# expected is the next token of the top level array: '[', an element (or ']' right after '['), ',' or ']' after an element
+			buffer, pos, expected = '', 0, '['
+			for chunk in iter(lambda: f.read(chunk_size), ''):
+				buffer, pos = buffer[pos:] + chunk, 0
+				while expected is not None:
+					while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+						pos += 1
+					if pos == len(buffer):
+						break
+					if expected == '[':
+						assert buffer[pos] == '[', f'Expected JSON array [{data_path}]'
+						pos, expected = pos + 1, 'element or ]'
+					elif buffer[pos] == ']' and expected in ['element or ]', ', or ]']:
+						pos, expected = pos + 1, None
+					elif buffer[pos] == ',' and expected == ', or ]':
+						pos, expected = pos + 1, 'element'
+					else:
+						assert expected != ', or ]', f'Malformed JSON array [{data_path}]'
+						try:
+							t, pos = decoder.raw_decode(buffer, pos)
+						except json.JSONDecodeError:
+							# element continues in the next chunk
+							break
+						assert isinstance(t, dict), f'JSON array elements must be objects [{data_path}]'
+						expected = ', or ]'
+						yield t
+			assert expected is None and not buffer[pos:].strip(), f'Malformed JSON array [{data_path}]'
+
+	else:
+		yield from load(data_path)
+
 def save(data_path, transcript):
 	with open(data_path, 'w') as f:
 
@@ -89,6 +131,12 @@ def remap_speaker(transcript, speaker_perm):
 		t['speaker'], t['speaker_name'] = speaker_, speaker_names[speaker_]
 
 
+def index_speaker_names(names):
+	# names of several speakers joined with speaker_separator get no speaker id
+	speaker_names = [speaker_name_missing] + sorted(set(names))
+	return speaker_names, {speaker_name : i for i, speaker_name in enumerate([name for name in speaker_names if speaker_separator not in name])}
+
+
 def collect_speaker_names(transcript, speaker_names = [], num_speakers = 1, set_speaker_data = False):
 	#TODO: convert channel to 0+
 
@@ -112,8 +160,7 @@ def collect_speaker_names(transcript, speaker_names = [], num_speakers = 1, set_
 			speaker_names = [speaker_names.get(speaker, speaker_name_missing) for speaker in range(1 + max(speaker_names.keys()))]
 		
 		elif has_speaker_names:
-			speaker_names = [speaker_name_missing] + sorted(set(t['speaker_name'] for t in transcript))
-			speaker_names_index = {speaker_name : i for i, speaker_name in enumerate([name for name in speaker_names if speaker_separator not in name])}
+			speaker_names, speaker_names_index = index_speaker_names(t['speaker_name'] for t in transcript)
 			if set_speaker_data:
 				for t in transcript:
 					t['speaker'] = speaker_names_index.get(t['speaker_name'], speaker_missing)
@@ -6,6 +6,9 @@ import traceback
 import random
 import functools
 import gzip
+import json
+import math
+import struct
 import numpy
 import logging
 import typing
@@ -199,37 +202,136 @@ def gather_tensors(tensor: torch.Tensor, world_size: int) -> typing.List[torch.T
 
 
 class TensorBackedStringArray:
-	def __init__(self, strings, encoding = 'utf_16_le', device = 'cpu'):
-		strings = list(strings)
-		self.encoding = encoding
-		self.multiplier = dict(ascii = 1, utf_16_le = 2, utf_32_le = 4)[encoding]
-		self.data = torch.ByteTensor(torch.ByteStorage.from_buffer(''.join(strings).encode(encoding))).to(device)
-		self.cumlen = torch.tensor(list(map(len, strings)), dtype = torch.int64, device = device).cumsum(dim = 0)
-		assert len(strings) == 0 or int(self.cumlen[-1]) * self.multiplier == len(self.data), f'[{encoding}] is not enough to hold characters, use a larger character class'
+	'''
+	Strings stored as one UTF-8 byte tensor with int64 byte offsets: string i is data[offsets[i] : offsets[i + 1]]
+	'''
+	def __init__(self, strings = [], device = 'cpu'):
+		encoded = [s.encode('utf-8') for s in strings]
+		self.data = torch.from_numpy(numpy.frombuffer(b''.join(encoded), dtype = numpy.uint8).copy()).to(device)
+		self.offsets = torch.tensor([0] + list(map(len, encoded)), dtype = torch.int64).cumsum(dim = 0).to(device)
+
+	@classmethod
+	def from_tensors(cls, data, offsets):
+		strings = cls.__new__(cls)
+		strings.data, strings.offsets = data, offsets
+		return strings
 
 	def __getitem__(self, i):
-		return bytes(self.data[(self.cumlen[i - 1] * self.multiplier if i >= 1 else 0) : self.cumlen[i] * self.multiplier]).decode(self.encoding)
+		if isinstance(i, slice):
+			return self.take(range(len(self))[i])
+		i = int(i) + (len(self) if i < 0 else 0)
+		if not 0 <= i < len(self):
+			raise IndexError(i)
+		return self.data[int(self.offsets[i]) : int(self.offsets[i + 1])].cpu().numpy().tobytes().decode('utf-8')
 
 	def __len__(self):
-		return len(self.cumlen)
+		return len(self.offsets) - 1
 
-	def __list__(self):
-		return [self[i] for i in range(len(self))]
+	def __iter__(self):
+		return iter(self.take(range(len(self))))
+
+	def take(self, indices):
+		# bytes of all requested strings are gathered and copied to host at once, then split
+		indices = torch.as_tensor(indices, dtype = torch.int64, device = self.offsets.device)
+		begin, lengths = self.offsets[indices], self.offsets[indices + 1] - self.offsets[indices]
+		starts = lengths.cumsum(dim = 0) - lengths
+		positions = torch.arange(int(lengths.sum()), device = self.data.device) + (begin - starts).repeat_interleave(lengths)
+		buffer = self.data[positions].cpu().numpy().tobytes()
+		return [buffer[b:b + l].decode('utf-8') for b, l in zip(starts.tolist(), lengths.tolist())]
 
 	def to(self, device):
 		self.data = self.data.to(device)
-		self.cumlen = self.cumlen.to(device)
+		self.offsets = self.offsets.to(device)
 		return self
 
-	def synchronize(self, world_size):
-		cumlen = gather_tensors(self.cumlen, world_size)
-		data = gather_tensors(self.data, world_size)
-
-		# cat synchronized data
-		for i in range(1, world_size):
-			cumlen[i] += cumlen[i-1][-1]
-
-		self.data = torch.cat(data, dim=0)
-		self.cumlen = torch.cat(cumlen, dim=0)
+	def save(self, path):
+		with open(path, 'wb') as f:
+			f.write(struct.pack('<q', len(self)))
+			f.write(self.offsets.cpu().numpy().astype('<i8').tobytes())
+			f.write(self.data.cpu().numpy().tobytes())
 
+	@classmethod
+	def load(cls, path):
+		# copy-on-write mapping, pages are shared with other processes mapping the same file
+		buffer = numpy.memmap(path, dtype = numpy.uint8, mode = 'c')
+		num_strings = int(buffer[:8].view('<i8')[0])
+		data_offset = 8 + 8 * (num_strings + 1)
+		return cls.from_tensors(torch.from_numpy(buffer[data_offset:]), torch.from_numpy(buffer[8:data_offset].view('<i8')))
 
+	def synchronize(self, world_size):
+		# lengths and bytes are packed into one uint8 tensor, so that a single all_gather (after the shape exchange) moves both
+		lengths = (self.offsets[1:] - self.offsets[:-1]).cpu().numpy().astype('<i8')
+		packed = numpy.concatenate([numpy.array([len(lengths)], dtype = '<i8').view(numpy.uint8), lengths.view(numpy.uint8), self.data.cpu().numpy()])
+		gathered = gather_tensors(torch.from_numpy(packed).to(self.data.device), world_size)
+
+		lengths, data = [], []
+		for packed in gathered:
+			packed = packed.cpu().numpy()
+			num_strings = int(packed[:8].view('<i8')[0])
+			lengths.append(packed[8:8 + 8 * num_strings].view('<i8'))
+			data.append(packed[8 + 8 * num_strings:])
+
+		self.data = torch.from_numpy(numpy.concatenate(data)).to(self.data.device)
+		self.offsets = torch.from_numpy(numpy.concatenate([numpy.zeros(1, dtype = '<i8')] + lengths).cumsum()).to(self.offsets.device)
+
+
+def save_columnar(path, state_dict, alignment = 64):
+	'''
+	Saves a flat dict of tensors, lists of tensors, TensorBackedStringArray and JSON values as a JSON header followed by
+	aligned raw arrays, that load_columnar maps into memory without copying
+	'''
+	header, arrays, size = {}, [], 0
+
+	def add(tensor):
+		nonlocal size
+		array = tensor.contiguous().numpy()
+		offset = int(math.ceil(size / alignment)) * alignment
+		arrays.append((offset, array))
+		size = offset + array.nbytes
+		return [array.dtype.str, list(array.shape), offset]
+
+	for k, v in state_dict.items():
+		if isinstance(v, torch.Tensor):
+			header[k] = dict(tensor = add(v))
+		elif isinstance(v, TensorBackedStringArray):
+			header[k] = dict(strings = add(v.data), offsets = add(v.offsets))
+		elif isinstance(v, list) and len(v) > 0 and all(isinstance(t, torch.Tensor) for t in v):
+			header[k] = dict(tensors = list(map(add, v)))
+		else:
+			header[k] = dict(value = v)
+
+	header = json.dumps(header, ensure_ascii = False).encode('utf-8')
+	data_offset = int(math.ceil((8 + len(header)) / alignment)) * alignment
+	with open(path, 'wb') as f:
+		f.write(struct.pack('<Q', len(header)))
+		f.write(header)
+		for offset, array in arrays:
+			f.seek(data_offset + offset)
+			f.write(array.data if array.nbytes > 0 else b'')
+		f.truncate(data_offset + size)
+
+
+def load_columnar(path, alignment = 64):
+	with open(path, 'rb') as f:
+		header = json.loads(f.read(struct.unpack('<Q', f.read(8))[0]).decode('utf-8'))
+		data_offset = int(math.ceil(f.tell() / alignment)) * alignment
+
+	# copy-on-write mapping: pages are shared by all processes mapping the file, including forked DataLoader workers
+	buffer = numpy.memmap(path, dtype = numpy.uint8, mode = 'c')
+
+	def get(dtype, shape, offset):
+		dtype = numpy.dtype(dtype)
+		begin = data_offset + offset
+		return torch.from_numpy(buffer[begin:begin + dtype.itemsize * int(numpy.prod(shape))].view(dtype).reshape(shape))
+
+	state_dict = {}
+	for k, v in header.items():
+		if 'tensor' in v:
+			state_dict[k] = get(*v['tensor'])
+		elif 'strings' in v:
+			state_dict[k] = TensorBackedStringArray.from_tensors(get(*v['strings']), get(*v['offsets']))
+		elif 'tensors' in v:
+			state_dict[k] = [get(*t) for t in v['tensors']]
+		else:
+			state_dict[k] = v['value']
+	return state_dict